@@ -0,0 +1,346 @@
+import bisect
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from rapidfuzz import fuzz, process
+from sqlalchemy import bindparam, func, text
+from databases import db, Clique, CliqueUser, MapChange, map_change_ids, map_change_log_start
+
+""" clique search and name autocomplete, behind the backend returned by get_search_backend():
+
+the database's own text index when it has one: FTS5 tables kept in sync by triggers on SQLite, pg_trgm GIN indexes
+on PostgreSQL (both created by upgrade_database). Otherwise, or with CLIQUE_SEARCH_BACKEND=memory, in-memory indexes:
+a trigram inverted index over the names and descriptions of the searchable cliques narrows a query down to the few
+cliques it can match before they are fuzzy scored, and a sorted array of their name words answers autocomplete
+prefixes. Those are kept per process and caught up with cliques created, changed or deleted (by any process)
+through the map change log, like the nearby index. Joining or leaving a clique isn't a map change, the member counts
+that rank autocomplete are counted again every AUTOCOMPLETE_MAX_AGE seconds instead """
+
+SEARCHABLE_VISIBILITIES = ("Public", "Protected")
+AUTOCOMPLETE_MAX_AGE = 5  # seconds autocomplete answers from memory before catching up, and member counts are kept
+MIN_SCORE = 60  # partial_ratio a name or description must reach to match
+MIN_SHARED_TRIGRAMS = 0.3  # share of the query's trigrams a candidate must contain
+SQLITE_CANDIDATES = 500  # cliques sharing the most trigrams with the query that SQLite hands over for scoring
+NAME_BONUS = 0.1  # the 10 points out of 100 name matches get over description matches, on the databases' scales
+
+
+def trigrams(text):
+    # pg_trgm style: every word padded with two spaces in front and one behind, so short words still count
+    grams = set()
+    for word in words(text):
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+def words(text):
+    return re.findall(r"\w+", text.lower())
+
+
+def rank_matches(query, candidates):
+    """ ids of the candidates, (clique_id, lowercase name, lowercase description), whose name or description
+    partially matches the lowercase query, best first: name matches rank above description matches """
+    if not candidates:
+        return []
+    # one vectorized pass over the candidates' names followed by their descriptions
+    choices = [name for _, name, _ in candidates] + [description for _, _, description in candidates]
+    scores = process.cdist([query], choices, scorer=fuzz.partial_ratio)[0]
+
+    matched = []
+    for (clique_id, _, _), name_score, desc_score in zip(candidates, scores, scores[len(candidates):]):
+        if name_score >= MIN_SCORE or desc_score >= MIN_SCORE:
+            matched.append((name_score + (10 if name_score >= desc_score else 0), clique_id))
+    matched.sort(key=lambda item: (-item[0], item[1]))
+    return [clique_id for _, clique_id in matched]
+
+
+class CliqueSearchIndex:
+    def __init__(self, change_id=0):
+        self.change_id = change_id  # last map change reflected here
+        self.texts = {}  # clique_id -> (lowercase name, lowercase description)
+        self.grams = {}  # clique_id -> trigrams of its name and description
+        self.postings = {}  # trigram -> clique ids
+        self.names = {}  # clique_id -> name as written
+        self.members = {}  # clique_id -> member count
+        self.name_words = []  # sorted (word of a name, clique_id)
+        self.checked_at = 0.0  # monotonic time of the last look at the map change log
+        self.counted_at = 0.0  # monotonic time the member counts were last read
+
+    def add(self, clique_id, name, description, members=0):
+        self.remove(clique_id)
+        self.names[clique_id] = name or ""
+        self.members[clique_id] = members
+        name, description = (name or "").lower(), (description or "").lower()
+        self.texts[clique_id] = (name, description)
+        self.grams[clique_id] = trigrams(name) | trigrams(description)
+        for gram in self.grams[clique_id]:
+            self.postings.setdefault(gram, set()).add(clique_id)
+        for word in set(words(name)):
+            bisect.insort(self.name_words, (word, clique_id))
+
+    def remove(self, clique_id):
+        name = self.names.pop(clique_id, None)
+        if name is None:
+            return
+        self.members.pop(clique_id)
+        self.texts.pop(clique_id)
+        for gram in self.grams.pop(clique_id):
+            clique_ids = self.postings[gram]
+            clique_ids.discard(clique_id)
+            if not clique_ids:
+                del self.postings[gram]
+        for word in set(words(name)):
+            del self.name_words[bisect.bisect_left(self.name_words, (word, clique_id))]
+
+    def _with_prefix(self, prefix):
+        # ids of the cliques with a name word starting with prefix, a binary search for the start of the run
+        clique_ids = set()
+        position = bisect.bisect_left(self.name_words, (prefix,))
+        while position < len(self.name_words) and self.name_words[position][0].startswith(prefix):
+            clique_ids.add(self.name_words[position][1])
+            position += 1
+        return clique_ids
+
+    def complete(self, term, limit):
+        """ names of the cliques with a name word starting with every word of the term, most members first """
+        prefixes = words(term)
+        if not prefixes:
+            return []
+        with _lock:  # other requests' catching up changes the index in place
+            clique_ids = self._with_prefix(prefixes[0])
+            for prefix in prefixes[1:]:
+                clique_ids &= self._with_prefix(prefix)
+            ranked = sorted(clique_ids,
+                            key=lambda clique_id: (-self.members[clique_id], self.names[clique_id], clique_id))
+
+            names = []
+            for clique_id in ranked:
+                if self.names[clique_id] not in names:
+                    names.append(self.names[clique_id])
+                    if len(names) == limit:
+                        break
+            return names
+
+    def search(self, query):
+        """ ids of the cliques matching the query, best first: name matches rank above description matches """
+        query = query.lower()
+        query_grams = trigrams(query)
+        if not query_grams:
+            return []
+
+        needed = max(1, math.ceil(len(query_grams) * MIN_SHARED_TRIGRAMS))
+        with _lock:  # other requests' catching up changes the index in place, the candidates are scored outside
+            shared = Counter(clique_id for gram in query_grams for clique_id in self.postings.get(gram, ()))
+            candidates = [(clique_id, *self.texts[clique_id]) for clique_id, count in shared.items() if count >= needed]
+        return rank_matches(query, candidates)
+
+
+_index = None
+_lock = threading.RLock()
+
+
+def _load_cliques(index, clique_ids=None):
+    # names, descriptions and member counts of the given cliques (all of them when None), cliques that no longer
+    # exist or are no longer searchable are dropped
+    query = db.session.query(Clique.id, Clique.name, Clique.description) \
+        .filter(Clique.visibility.in_(SEARCHABLE_VISIBILITIES))
+    members = db.session.query(CliqueUser.clique_id, func.count()).group_by(CliqueUser.clique_id)
+    if clique_ids is not None:
+        query = query.filter(Clique.id.in_(clique_ids))
+        members = members.filter(CliqueUser.clique_id.in_(clique_ids))
+
+    rows = {clique_id: (name, description) for clique_id, name, description in query.all()}
+    member_counts = dict(members.all())
+
+    for clique_id in (clique_ids or []):
+        if clique_id not in rows:
+            index.remove(clique_id)
+    for clique_id, (name, description) in rows.items():
+        index.add(clique_id, name, description, member_counts.get(clique_id, 0))
+
+
+def _count_members(index):
+    member_counts = dict(db.session.query(CliqueUser.clique_id, func.count()).group_by(CliqueUser.clique_id).all())
+    for clique_id in index.members:
+        index.members[clique_id] = member_counts.get(clique_id, 0)
+    index.counted_at = time.monotonic()
+
+
+def get_clique_search_index(max_age=None):
+    """ the process' index, built on first use and then brought up to date with the cliques changed since (by any
+    process) by replaying the whole-clique entries of the map change log, or built again when the entries to replay
+    were pruned. With max_age (seconds), the log is only looked at when it was last checked longer ago than that, so
+    frequent callers are answered from memory alone """
+    global _index
+    with _lock:
+        if _index is not None and max_age is not None and time.monotonic() - _index.checked_at < max_age:
+            return _index
+        settled, latest = map_change_ids()
+        if _index is None or (latest > _index.change_id and _index.change_id < map_change_log_start()):
+            _index = CliqueSearchIndex(settled)
+            _load_cliques(_index)
+            _index.counted_at = time.monotonic()
+        elif latest > _index.change_id:
+            changed = [clique_id for (clique_id,) in db.session.query(MapChange.clique_id).filter(
+                MapChange.id > _index.change_id, MapChange.id <= latest, MapChange.marker_id.is_(None)
+            ).distinct()]
+            if changed:
+                _load_cliques(_index, changed)
+            _index.change_id = settled  # what lies above is replayed again next time
+        if time.monotonic() - _index.counted_at >= AUTOCOMPLETE_MAX_AGE:
+            _count_members(_index)
+        _index.checked_at = time.monotonic()
+        return _index
+
+
+# database text indexes
+def sqlite_fts_table(table, tokenize):
+    # external content table: the text stays in cliques, the FTS table only holds the index
+    suffix = table.removeprefix("clique_")
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {table} USING fts5("
+        f"name, description, content='cliques', content_rowid='id', tokenize='{tokenize}')",
+        f"CREATE TRIGGER IF NOT EXISTS cliques_{suffix}_insert AFTER INSERT ON cliques BEGIN "
+        f"INSERT INTO {table} (rowid, name, description) VALUES (new.id, new.name, new.description); END",
+        f"CREATE TRIGGER IF NOT EXISTS cliques_{suffix}_delete AFTER DELETE ON cliques BEGIN "
+        f"INSERT INTO {table} ({table}, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+        "END",
+        f"CREATE TRIGGER IF NOT EXISTS cliques_{suffix}_update AFTER UPDATE OF name, description ON cliques BEGIN "
+        f"INSERT INTO {table} ({table}, rowid, name, description) VALUES ('delete', old.id, old.name, old.description); "
+        f"INSERT INTO {table} (rowid, name, description) VALUES (new.id, new.name, new.description); END",
+    ]
+
+
+SQLITE_SCHEMA = {
+    "clique_fts": sqlite_fts_table("clique_fts", "unicode61 remove_diacritics 2"),  # name word prefixes
+    "clique_trigrams": sqlite_fts_table("clique_trigrams", "trigram"),  # substrings, SQLite 3.34 and later
+}
+
+POSTGRES_SCHEMA = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_cliques_name_trgm ON cliques USING gin (lower(name) gin_trgm_ops)",
+    "CREATE INDEX IF NOT EXISTS ix_cliques_description_trgm ON cliques USING gin (lower(description) gin_trgm_ops)",
+]
+
+
+def install_search_index():
+    """ create the database's text index over the cliques, on the databases that have one """
+    dialect = db.engine.dialect.name
+    with db.engine.begin() as conn:
+        if dialect == "sqlite" and sqlite3.sqlite_version_info >= (3, 34):
+            for table, statements in SQLITE_SCHEMA.items():
+                existed = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :table"), {"table": table}).first()
+                for statement in statements:
+                    conn.execute(text(statement))
+                if existed is None:
+                    conn.execute(text(f"INSERT INTO {table} ({table}) VALUES ('rebuild')"))  # index existing cliques
+        elif dialect == "postgresql":
+            for statement in POSTGRES_SCHEMA:
+                conn.execute(text(statement))
+
+
+def _searchable(statement):
+    return text(statement).bindparams(bindparam("visibilities", list(SEARCHABLE_VISIBILITIES), expanding=True))
+
+
+def _ranked_names(matches, params, limit):
+    # names of the matching cliques (matches: FROM and WHERE clauses over cliques), most members first, a name
+    # shared by several cliques listed once
+    rows = db.session.execute(_searchable(
+        "SELECT name FROM (SELECT cliques.name AS name, "
+        "(SELECT COUNT(*) FROM clique_user WHERE clique_user.clique_id = cliques.id) AS members "
+        f"{matches} AND cliques.visibility IN :visibilities) AS matches "
+        "GROUP BY name ORDER BY MAX(members) DESC, name LIMIT :limit"
+    ), {**params, "limit": limit})
+    return [name for (name,) in rows]
+
+
+class SqliteSearchBackend:
+    """ FTS5: the trigram table narrows a search down to the cliques containing any of the query's trigrams,
+    which are then scored like the in-memory index does, so typos and parts of words still match. Autocomplete
+    needs every word of the term to start a word of the name """
+
+    def search(self, query):
+        query = query.lower()
+        grams = {word[i:i + 3] for word in words(query) for i in range(len(word) - 2)}
+        if not grams:
+            return []
+        rows = db.session.execute(_searchable(
+            "SELECT cliques.id, cliques.name, cliques.description "
+            "FROM clique_trigrams JOIN cliques ON cliques.id = clique_trigrams.rowid "
+            "WHERE clique_trigrams MATCH :match AND cliques.visibility IN :visibilities "
+            "ORDER BY bm25(clique_trigrams, :name_weight, 1.0), cliques.id LIMIT :candidates"
+        ), {"match": " OR ".join(f'"{gram}"' for gram in sorted(grams)), "name_weight": 1 / NAME_BONUS,
+            "candidates": SQLITE_CANDIDATES})
+        return rank_matches(query, [(clique_id, (name or "").lower(), (description or "").lower())
+                                    for clique_id, name, description in rows])
+
+    def complete(self, term, limit):
+        terms = [f'name : "{word}"*' for word in words(term)]
+        if not terms:
+            return []
+        return _ranked_names("FROM clique_fts JOIN cliques ON cliques.id = clique_fts.rowid WHERE clique_fts MATCH :match",
+                             {"match": " AND ".join(terms)}, limit)
+
+
+class PostgresSearchBackend:
+    """ pg_trgm: the query must be similar to a part of the name or description (word_similarity, the partial match
+    of similarity()), ranked by that similarity with name matches first """
+
+    def search(self, query):
+        query = query.lower()
+        rows = db.session.execute(_searchable(
+            "SELECT id FROM cliques "
+            "WHERE visibility IN :visibilities AND (:query <% lower(name) OR :query <% lower(description)) "
+            "ORDER BY GREATEST(word_similarity(:query, lower(name)) + :name_bonus, "
+            "word_similarity(:query, lower(description))) DESC, id"
+        ), {"query": query, "name_bonus": NAME_BONUS})
+        return [clique_id for (clique_id,) in rows]
+
+    def complete(self, term, limit):
+        prefixes = words(term)
+        if not prefixes:
+            return []
+        # \m anchors each prefix to the start of a word, the trigram index serves the regular expressions
+        conditions = " AND ".join(f"lower(cliques.name) ~ :prefix{i}" for i in range(len(prefixes)))
+        return _ranked_names(f"FROM cliques WHERE {conditions}",
+                             {f"prefix{i}": r"\m" + prefix for i, prefix in enumerate(prefixes)}, limit)
+
+
+class MemorySearchBackend:
+    """ the in-memory indexes, for databases without a text index """
+
+    def search(self, query):
+        return get_clique_search_index().search(query)
+
+    def complete(self, term, limit):
+        return get_clique_search_index(max_age=AUTOCOMPLETE_MAX_AGE).complete(term, limit)
+
+
+_backend = None
+
+
+def create_backend():
+    if os.getenv("CLIQUE_SEARCH_BACKEND", "database") == "database":
+        dialect = db.engine.dialect.name
+        if dialect == "sqlite" and db.session.execute(
+                text("SELECT 1 FROM sqlite_master WHERE name = 'clique_trigrams'")).first():
+            return SqliteSearchBackend()
+        if dialect == "postgresql" and db.session.execute(
+                text("SELECT 1 FROM pg_indexes WHERE indexname = 'ix_cliques_name_trgm'")).first():
+            return PostgresSearchBackend()
+    return MemorySearchBackend()  # or until upgrade_database has created the text index
+
+
+def get_search_backend():
+    """ the search interface of search_cliques and autocomplete: search(query) -> clique ids, best first, and
+    complete(term, limit) -> clique names """
+    global _backend
+    with _lock:
+        if _backend is None:
+            _backend = create_backend()
+        return _backend
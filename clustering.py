@@ -0,0 +1,254 @@
+import math
+import threading
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from databases import db, Marker, UserMarker, MapChange, map_change_ids, map_change_log_start
+
+""" server-side marker clustering: one hierarchical grid index per clique, kept in memory per process and caught up
+with other processes' writes through the map change log """
+
+MAX_CLUSTER_ZOOM = 16  # above this zoom the index returns individual markers
+CELL_SHIFT = 2  # 2^CELL_SHIFT cells per 256px tile, i.e. clusters span a 64px cell on screen
+
+
+def project(lat, lng):
+    # web mercator, normalised to [0, 1] on both axes (y grows southwards like tile coordinates)
+    x = (lng + 180.0) / 360.0
+    sin = math.sin(math.radians(max(min(lat, 85.0511), -85.0511)))
+    y = 0.5 - math.log((1 + sin) / (1 - sin)) / (4 * math.pi)
+    return min(max(x, 0.0), 1.0), min(max(y, 0.0), 1.0)
+
+
+def unproject(x, y):
+    lng = x * 360.0 - 180.0
+    lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y))))
+    return lat, lng
+
+
+class ClusterIndex:
+    """ quadtree of grid cells: the cells of zoom z nest exactly inside the cells of zoom z - 1,
+    so adding or removing a marker only touches one cell per zoom level """
+
+    def __init__(self, max_zoom=MAX_CLUSTER_ZOOM):
+        self.max_zoom = max_zoom
+        self.points = {}  # marker_id -> (x, y, lat, lng, rating)
+        self.levels = [{} for _ in range(max_zoom + 1)]  # zoom -> {(cx, cy): cell}
+
+    def _cell_key(self, zoom, x, y):
+        cells = 1 << (zoom + CELL_SHIFT)
+        return min(int(x * cells), cells - 1), min(int(y * cells), cells - 1)
+
+    def add(self, marker_id, lat, lng, rating):
+        if marker_id in self.points:
+            self.remove(marker_id)
+
+        x, y = project(lat, lng)
+        self.points[marker_id] = (x, y, lat, lng, rating)
+        for zoom, level in enumerate(self.levels):
+            cell = level.setdefault(self._cell_key(zoom, x, y), {"ids": set(), "sum_x": 0.0, "sum_y": 0.0,
+                                                                 "rating_sum": 0.0})
+            cell["ids"].add(marker_id)
+            cell["sum_x"] += x
+            cell["sum_y"] += y
+            cell["rating_sum"] += rating
+
+    def remove(self, marker_id):
+        point = self.points.pop(marker_id, None)
+        if point is None:
+            return
+
+        x, y, _, _, rating = point
+        for zoom, level in enumerate(self.levels):
+            key = self._cell_key(zoom, x, y)
+            cell = level[key]
+            cell["ids"].discard(marker_id)
+            if not cell["ids"]:
+                del level[key]
+                continue
+            cell["sum_x"] -= x
+            cell["sum_y"] -= y
+            cell["rating_sum"] -= rating
+
+    def update_rating(self, marker_id, rating):
+        point = self.points.get(marker_id)
+        if point is not None:
+            self.add(marker_id, point[2], point[3], rating)
+
+    def _cells_in_bbox(self, zoom, bbox):
+        min_lon, min_lat, max_lon, max_lat = bbox
+        min_cx, min_cy = self._cell_key(zoom, *project(max_lat, min_lon))
+        max_cx, max_cy = self._cell_key(zoom, *project(min_lat, max_lon))
+        level = self.levels[zoom]
+
+        # walk whichever is smaller: the cells covering the box, or the occupied cells of the level
+        if (max_cx - min_cx + 1) * (max_cy - min_cy + 1) <= len(level):
+            for cx in range(min_cx, max_cx + 1):
+                for cy in range(min_cy, max_cy + 1):
+                    if (cx, cy) in level:
+                        yield (cx, cy), level[(cx, cy)]
+        else:
+            for (cx, cy), cell in level.items():
+                if min_cx <= cx <= max_cx and min_cy <= cy <= max_cy:
+                    yield (cx, cy), cell
+
+    def _expansion_zoom(self, zoom, key):
+        # first zoom at which the cell's markers no longer share a single cell
+        cx, cy = key
+        while zoom < self.max_zoom:
+            zoom += 1
+            cx, cy = cx * 2, cy * 2
+            children = [(cx + dx, cy + dy) for dx in (0, 1) for dy in (0, 1) if (cx + dx, cy + dy) in self.levels[zoom]]
+            if len(children) > 1:
+                return zoom
+            cx, cy = children[0]
+        return self.max_zoom + 1
+
+    def _cluster_feature(self, zoom, key, cell):
+        count = len(cell["ids"])
+        lat, lng = unproject(cell["sum_x"] / count, cell["sum_y"] / count)
+        return {
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [lng, lat]
+            },
+            "properties": {
+                "cluster": True,
+                "cluster_id": f"{zoom}:{key[0]}:{key[1]}",
+                "point_count": count,
+                "average_review": round(cell["rating_sum"] / count, 2),
+                "expansion_zoom": self._expansion_zoom(zoom, key)
+            }
+        }
+
+    def query_tile(self, zoom, x, y):
+        """ clusters and individual marker ids of web-mercator tile (zoom, x, y), each cell lies in exactly one tile """
+        with _lock:  # other requests' catching up patches the index in place
+            level_zoom = min(zoom, self.max_zoom)
+            cells_per_tile = (1 << (level_zoom + CELL_SHIFT)) / (1 << zoom)
+            level = self.levels[level_zoom]
+
+            if cells_per_tile >= 1:
+                side = int(cells_per_tile)
+                keys = [(cx, cy) for cx in range(x * side, (x + 1) * side) for cy in range(y * side, (y + 1) * side)]
+            else:
+                # tile smaller than a cell: take the cell around it, then keep the points projecting into the tile
+                ratio = int(1 / cells_per_tile)
+                keys = [(x // ratio, y // ratio)]
+
+            clusters = []
+            marker_ids = []
+            tiles = 1 << zoom
+            for key in keys:
+                cell = level.get(key)
+                if cell is None:
+                    continue
+                if zoom <= self.max_zoom and len(cell["ids"]) > 1:
+                    clusters.append(self._cluster_feature(zoom, key, cell))
+                    continue
+                marker_ids.extend(
+                    marker_id for marker_id in cell["ids"]
+                    if min(int(self.points[marker_id][0] * tiles), tiles - 1) == x
+                    and min(int(self.points[marker_id][1] * tiles), tiles - 1) == y
+                )
+            return clusters, marker_ids
+
+    def query(self, zoom, bbox):
+        """ clusters and individual marker ids to display inside bbox=(minLon, minLat, maxLon, maxLat) at zoom """
+        with _lock:  # other requests' catching up patches the index in place
+            zoom = max(zoom, 0)
+            if zoom > self.max_zoom:
+                min_lon, min_lat, max_lon, max_lat = bbox
+                marker_ids = [
+                    marker_id
+                    for _, cell in self._cells_in_bbox(self.max_zoom, bbox)
+                    for marker_id in cell["ids"]
+                    if min_lat <= self.points[marker_id][2] <= max_lat
+                    and min_lon <= self.points[marker_id][3] <= max_lon
+                ]
+                return [], marker_ids
+
+            clusters = []
+            marker_ids = []
+            for key, cell in self._cells_in_bbox(zoom, bbox):
+                if len(cell["ids"]) == 1:
+                    marker_ids.extend(cell["ids"])
+                    continue
+                clusters.append(self._cluster_feature(zoom, key, cell))
+            return clusters, marker_ids
+
+
+_indexes = {}  # clique_id -> ClusterIndex
+_change_id = None  # last map change reflected by the indexes
+_lock = threading.RLock()
+
+
+def _load_markers(index, clique_id, marker_ids=None):
+    # positions and ratings of the given markers of the clique (all of them when None), markers that are no longer
+    # in the clique are dropped
+    query = db.session.query(Marker.id, Marker.lat, Marker.long, Marker.average_review) \
+        .join(UserMarker, UserMarker.marker_id == Marker.id).filter(UserMarker.clique_id == clique_id)
+    if marker_ids is not None:
+        query = query.filter(Marker.id.in_(marker_ids))
+    rows = query.all()
+
+    for marker_id in set(marker_ids or ()) - {row[0] for row in rows}:
+        index.remove(marker_id)
+    for marker_id, lat, lng, rating in rows:
+        index.add(marker_id, lat, lng, rating)
+
+
+def _catch_up():
+    # replay the map changes logged since the last call (by any process): changed markers are reloaded into the
+    # indexes of their clique, an index whose whole clique changed is dropped and rebuilt on next use
+    global _change_id
+    settled, latest = map_change_ids()
+    if _change_id is None or (latest > _change_id and _change_id < map_change_log_start()):
+        _indexes.clear()  # nothing built yet, or the entries to replay were pruned
+    elif latest > _change_id and _indexes:
+        changed = {}
+        for clique_id, marker_id in db.session.query(MapChange.clique_id, MapChange.marker_id).filter(
+            MapChange.id > _change_id, MapChange.id <= latest, MapChange.clique_id.in_(list(_indexes))
+        ).distinct():
+            changed.setdefault(clique_id, set()).add(marker_id)
+        for clique_id, marker_ids in changed.items():
+            if None in marker_ids:
+                del _indexes[clique_id]
+            else:
+                _load_markers(_indexes[clique_id], clique_id, marker_ids)
+    _change_id = settled  # what lies above is replayed again next time
+
+
+def get_cluster_index(clique_id):
+    """ the clique's index, built on first use and then brought up to date with the writes committed since (by any
+    process) by replaying the map change log, like the nearby index """
+    with _lock:
+        _catch_up()
+        index = _indexes.get(clique_id)
+        if index is None:
+            index = ClusterIndex()
+            _load_markers(index, clique_id)
+            _indexes[clique_id] = index
+        return index
+
+
+# the indexes only ever reflect committed writes, but a replay may read the session's own uncommitted log entries:
+# when those are rolled back, the indexes of their cliques are dropped
+@event.listens_for(Session, 'after_flush')
+def _collect_logged_cliques(session, flush_context):
+    logged = session.info.setdefault('cluster_cliques', set())
+    logged.update(obj.__dict__.get('clique_id') for obj in session.new if isinstance(obj, MapChange))
+
+
+@event.listens_for(Session, 'after_commit')
+def _forget_logged_cliques(session):
+    session.info.pop('cluster_cliques', None)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _drop_logged_cliques(session):
+    logged = session.info.pop('cluster_cliques', None)
+    if logged:
+        with _lock:
+            for clique_id in logged:
+                _indexes.pop(clique_id, None)
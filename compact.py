@@ -0,0 +1,74 @@
+import json
+import struct
+import numpy as np
+
+""" compact columnar encoding of the map's slim features and clusters, the alternative to GeoJSON that clients of
+the marker tiles (static/js/universal.js decodes them) and of /geojson-features ask for with
+Accept: application/x-geocliques-compact. A response is a sequence of blocks, one per clique for a tile (empty ones
+left out), each laid out as below and padded with zero bytes to a multiple of 4
+
+layout, all little-endian:
+    "GCM1" magic, uint32 row count, uint32 header length
+    header: utf-8 JSON {"cliques": [[id, name, color, icon], ...], "dates": ["YYYY-MM-DD", ...]}, the string tables,
+    padded with spaces so the arrays start at a multiple of 4 bytes
+    one array per column, in order:
+        float32 lat, float32 long, uint32 marker_id (0 for clusters), float32 average_review,
+        uint32 total_reviews, uint32 point_count (1 for markers), uint16 clique index, uint16 date index
+        (NO_DATE when there is no upcoming event), uint8 expansion_zoom (0 for markers)
+"""
+
+COMPACT_MIMETYPE = 'application/x-geocliques-compact'
+MAGIC = b'GCM1'
+NO_DATE = 0xFFFF
+
+
+def encode_compact_features(features):
+    cliques = {}  # clique_id -> index in the clique table
+    clique_table = []
+    dates = {}
+    date_table = []
+    columns = {name: [] for name in ("lat", "long", "marker_id", "average_review", "total_reviews", "point_count",
+                                     "clique", "date", "expansion_zoom")}
+
+    for feature in features:
+        props = feature["properties"]
+        lng, lat = feature["geometry"]["coordinates"]
+
+        if props["clique_id"] not in cliques:
+            cliques[props["clique_id"]] = len(clique_table)
+            clique_table.append([props["clique_id"], props["clique_name"], props.get("clique_color"), props["icon"]])
+
+        next_event_date = props.get("next_event_date")
+        if next_event_date is not None and next_event_date not in dates:
+            dates[next_event_date] = len(date_table)
+            date_table.append(next_event_date)
+
+        is_cluster = props.get("cluster", False)
+        columns["lat"].append(lat)
+        columns["long"].append(lng)
+        columns["marker_id"].append(0 if is_cluster else props["marker_id"])
+        columns["average_review"].append(props["average_review"] or 0)
+        columns["total_reviews"].append(0 if is_cluster else props["total_reviews"] or 0)
+        columns["point_count"].append(props["point_count"] if is_cluster else 1)
+        columns["clique"].append(cliques[props["clique_id"]])
+        columns["date"].append(NO_DATE if next_event_date is None else dates[next_event_date])
+        columns["expansion_zoom"].append(props["expansion_zoom"] if is_cluster else 0)
+
+    header = json.dumps({"cliques": clique_table, "dates": date_table}, separators=(',', ':')).encode()
+    header += b' ' * (-(len(MAGIC) + 8 + len(header)) % 4)  # keep the 4-byte arrays aligned for typed array views
+
+    return b''.join([
+        MAGIC,
+        struct.pack('<II', len(features), len(header)),
+        header,
+        np.asarray(columns["lat"], dtype='<f4').tobytes(),
+        np.asarray(columns["long"], dtype='<f4').tobytes(),
+        np.asarray(columns["marker_id"], dtype='<u4').tobytes(),
+        np.asarray(columns["average_review"], dtype='<f4').tobytes(),
+        np.asarray(columns["total_reviews"], dtype='<u4').tobytes(),
+        np.asarray(columns["point_count"], dtype='<u4').tobytes(),
+        np.asarray(columns["clique"], dtype='<u2').tobytes(),
+        np.asarray(columns["date"], dtype='<u2').tobytes(),
+        np.asarray(columns["expansion_zoom"], dtype='<u1').tobytes(),
+        b'\0' * (-len(features) % 4),  # the single-byte column leaves the next block unaligned otherwise
+    ])
@@ -1,8 +1,8 @@
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
-from sqlalchemy import ForeignKey, Integer, String, Float
+from sqlalchemy import ForeignKey, Integer, BigInteger, String, Float, Date, DateTime, Index, inspect, text, func
 from flask_login import UserMixin
-from datetime import datetime
+import datetime
 
 
 class Base(DeclarativeBase):
@@ -36,9 +36,10 @@ class Clique(db.Model):
     name: Mapped[str] = mapped_column(String(100))
     description: Mapped[str] = mapped_column(String(200))
     visibility: Mapped[str] = mapped_column(String(200))
-    date_created: Mapped[str] = mapped_column(String(100))
+    date_created: Mapped[datetime.date] = mapped_column(Date, default=datetime.date.today)
     admin_id: Mapped[int] = mapped_column(ForeignKey('users.id'))
     icon: Mapped[str] = mapped_column(String(100))
+    map_version: Mapped[int] = mapped_column(Integer, default=0, server_default='0')  # bumped by every map data write
 
     users = relationship('CliqueUser', back_populates='clique')
     markers = relationship('UserMarker', back_populates='clique')
@@ -50,8 +51,8 @@ class Clique(db.Model):
 class CliqueUser(db.Model):
     __tablename__ = 'clique_user'
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), primary_key=True)
-    clique_id: Mapped[int] = mapped_column(ForeignKey('cliques.id'), primary_key=True)
-    joined_date: Mapped[str] = mapped_column(String(100))
+    clique_id: Mapped[int] = mapped_column(ForeignKey('cliques.id'), primary_key=True, index=True)  # member counts
+    joined_date: Mapped[datetime.date] = mapped_column(Date, default=datetime.date.today, index=True)
 
     user = relationship('User', back_populates='cliques')
     clique = relationship('Clique', back_populates='users')
@@ -63,7 +64,7 @@ class UserMarker(db.Model):
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), primary_key=True)
     marker_id: Mapped[int] = mapped_column(ForeignKey('markers.id'), primary_key=True)
     clique_id: Mapped[int] = mapped_column(ForeignKey('cliques.id'), primary_key=True)
-    creation_date: Mapped[str] = mapped_column(String(100), default=lambda: datetime.today().strftime('%Y-%m-%d'))
+    creation_date: Mapped[datetime.date] = mapped_column(Date, default=datetime.date.today, index=True)
 
     user = relationship('User', back_populates='markers')
     clique = relationship('Clique', back_populates='markers')
@@ -78,7 +79,9 @@ class Marker(db.Model):
     long: Mapped[float] = mapped_column(Float, nullable=False)
     description: Mapped[str] = mapped_column(String(255), nullable=True)
     total_reviews: Mapped[int] = mapped_column(Integer, default=0)
-    average_review: Mapped[float] = mapped_column(Float, default=0.0)
+    stars_sum: Mapped[int] = mapped_column(Integer, default=0, server_default='0')  # of all the marker's reviews
+    average_review: Mapped[float] = mapped_column(Float, default=0.0)  # stars_sum / total_reviews, to 2 decimals
+    grid_cell: Mapped[int] = mapped_column(BigInteger, nullable=True, index=True)  # z-order cell of (lat, long)
 
     users = relationship('UserMarker', back_populates='marker')
     reviews = relationship('Review', back_populates='marker')
@@ -87,13 +90,16 @@ class Marker(db.Model):
 
 class Review(db.Model):
     __tablename__ = 'reviews'
+    # serves /marker/<id>/reviews: one marker's reviews, newest first
+    __table_args__ = (Index('ix_reviews_marker_id_creation_date_id', 'marker_id', 'creation_date', 'id'),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
     stars: Mapped[int] = mapped_column(Integer, nullable=False)  # 1 to 5
     commentary: Mapped[str] = mapped_column(String(500), nullable=True)
     marker_id: Mapped[int] = mapped_column(ForeignKey('markers.id'), nullable=False)
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), nullable=False)
-    creation_date: Mapped[str] = mapped_column(String(100), default=lambda: datetime.today().strftime('%Y-%m-%d'))
+    creation_date: Mapped[datetime.date] = mapped_column(Date, default=datetime.date.today, index=True)
+    score: Mapped[int] = mapped_column(Integer, nullable=True)  # scoreboard points of the commentary, set on write
 
     marker = relationship('Marker', back_populates='reviews')
     user = relationship('User', back_populates='reviews')
@@ -113,9 +119,11 @@ class Notification(db.Model):
 
 class Event(db.Model):
     __tablename__ = 'events'
+    # serves /events: one clique's events in a date range, already in agenda order
+    __table_args__ = (Index('ix_events_clique_id_date_time', 'clique_id', 'date', 'time'),)
 
     id: Mapped[int] = mapped_column(Integer, primary_key=True)
-    date: Mapped[str] = mapped_column(String(100))
+    date: Mapped[datetime.date] = mapped_column(Date, index=True)
     time: Mapped[str] = mapped_column(String(10))
     description: Mapped[str] = mapped_column(String(500), nullable=True)
     marker_id: Mapped[int] = mapped_column(ForeignKey('markers.id'), nullable=False)
@@ -133,7 +141,130 @@ class BannedUser(db.Model):
     user_id: Mapped[int] = mapped_column(ForeignKey('users.id'), primary_key=True)
     clique_id: Mapped[int] = mapped_column(ForeignKey('cliques.id'), primary_key=True)
     reason: Mapped[str] = mapped_column(String(100), nullable=True)
-    ban_date: Mapped[str] = mapped_column(String(100), default=lambda: datetime.today().strftime('%Y-%m-%d'))
+    ban_date: Mapped[datetime.date] = mapped_column(Date, default=datetime.date.today)
 
     user = relationship('User', back_populates='banned_users')
     clique = relationship('Clique', back_populates='banned_users')
+
+
+class CliqueScore(db.Model):
+    """ points each user earned in a clique (markers added, reviews of its markers), kept up to date by those
+    writes. The feed's scoreboards read them already ordered """
+    __tablename__ = 'clique_score'
+    __table_args__ = (Index('ix_clique_score_clique_id_score', 'clique_id', 'score'),)
+
+    # no foreign keys: rows are cleaned up with the cliques and users they belong to
+    clique_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    user_id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    score: Mapped[int] = mapped_column(Integer, default=0, server_default='0')
+
+
+class Activity(db.Model):
+    """ the /feed stream: one row per clique for every new marker, review, event or member, written along with it.
+    The fields shown in the feed are copied in, so reading it takes no joins """
+    __tablename__ = 'activity'
+    __table_args__ = (Index('ix_activity_clique_id_id', 'clique_id', 'id'),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)  # newest last, the cursor of /feed?before=
+    type: Mapped[str] = mapped_column(String(20))  # marker, review, event or join
+    date: Mapped[datetime.date] = mapped_column(Date, default=datetime.date.today)
+    clique_id: Mapped[int] = mapped_column(ForeignKey('cliques.id'), nullable=False)
+    clique_name: Mapped[str] = mapped_column(String(100))
+    user_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    user_name: Mapped[str] = mapped_column(String(100))
+    user_pic: Mapped[str] = mapped_column(String(200))
+    marker_id: Mapped[int] = mapped_column(Integer, nullable=True)
+    marker_name: Mapped[str] = mapped_column(String(255), nullable=True)
+    review_id: Mapped[int] = mapped_column(Integer, nullable=True, index=True)  # of a review entry, deleted with it
+    stars: Mapped[int] = mapped_column(Integer, nullable=True)
+    commentary: Mapped[str] = mapped_column(String(500), nullable=True)  # of a review, or an event's description
+    event_date: Mapped[datetime.date] = mapped_column(Date, nullable=True)
+    event_time: Mapped[str] = mapped_column(String(10), nullable=True)
+
+
+class MapChange(db.Model):
+    """ append-only log of map writes, its id is the cursor of /geojson-features?since= """
+    __tablename__ = 'map_changes'
+    __table_args__ = (Index('ix_map_changes_clique_id_id', 'clique_id', 'id'),)
+
+    id: Mapped[int] = mapped_column(Integer, primary_key=True)
+    # no foreign keys: entries outlive the markers and cliques they describe, that's how deletions are synced
+    clique_id: Mapped[int] = mapped_column(Integer, nullable=False)
+    marker_id: Mapped[int] = mapped_column(Integer, nullable=True)  # None: every marker of the clique changed
+    # where the marker is, for the tile caches to drop only the tiles around it (None without marker_id)
+    lat: Mapped[float] = mapped_column(Float, nullable=True)
+    long: Mapped[float] = mapped_column(Float, nullable=True)
+    created_at: Mapped[datetime.datetime] = mapped_column(DateTime, default=datetime.datetime.now, nullable=True,
+                                                          index=True)  # None for entries logged before it existed
+
+
+MAP_CHANGE_SETTLE = datetime.timedelta(seconds=60)  # longer than any transaction that logs map changes
+MAP_CHANGE_RETENTION = datetime.timedelta(days=7)  # map cursors expire daily, the per-process indexes catch up sooner
+
+
+def map_change_ids():
+    """ (settled id, latest id) of the map change log. Ids are handed out in insert order but entries show up in
+    commit order, so an id missing below the latest may still appear when its transaction commits. The settled id
+    is the one below the first such gap, a gap counts as rolled back once MAP_CHANGE_SETTLE has passed since the
+    entry after it was logged. Readers replay up to the latest id and resume from the settled one, so what lies
+    between them is replayed twice rather than missed """
+    latest = db.session.query(func.max(MapChange.id)).scalar() or 0
+    recent = [change_id for (change_id,) in db.session.query(MapChange.id).filter(
+        MapChange.created_at >= datetime.datetime.now() - MAP_CHANGE_SETTLE, MapChange.id <= latest
+    ).order_by(MapChange.id)]
+    if not recent:
+        return latest, latest
+
+    # ids logged within the settle time must follow the last older entry without a gap
+    expected = (db.session.query(func.max(MapChange.id)).filter(MapChange.id < recent[0]).scalar() or 0) + 1
+    for change_id in recent:
+        if change_id != expected:
+            return expected - 1, latest
+        expected += 1
+    return latest, latest
+
+
+def map_change_log_start():
+    """ the id the map change log is complete from: older entries were pruned, a reader that last saw an id below it
+    has to start over """
+    oldest = db.session.query(func.min(MapChange.id)).scalar()
+    return oldest - 1 if oldest is not None else 0
+
+
+def upgrade_schema():
+    """ create missing tables, then add the columns and indexes introduced after a database was first created """
+    db.create_all()
+    inspector = inspect(db.engine)
+    preparer = db.engine.dialect.identifier_preparer
+
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing_columns = {col['name'] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing_columns:
+                    continue
+                column_type = column.type.compile(dialect=db.engine.dialect)
+                default = f" DEFAULT {column.server_default.arg}" if column.server_default is not None else ""
+                conn.execute(text(
+                    f"ALTER TABLE {preparer.quote(table.name)} ADD COLUMN {preparer.quote(column.name)} {column_type}{default}"
+                ))
+
+    # dates used to be stored as 'YYYY-MM-DD' strings: PostgreSQL converts the column, SQLite keeps its text
+    # storage (which is what SQLAlchemy's Date uses there) and only needs the values trimmed to the date
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing_types = {col['name']: col['type'] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if not isinstance(column.type, Date) or isinstance(existing_types.get(column.name), Date):
+                    continue
+                table_name, column_name = preparer.quote(table.name), preparer.quote(column.name)
+                if db.engine.dialect.name == 'postgresql':
+                    conn.execute(text(f"ALTER TABLE {table_name} ALTER COLUMN {column_name} TYPE DATE "
+                                      f"USING NULLIF(TRIM({column_name}), '')::date"))
+                else:
+                    conn.execute(text(f"UPDATE {table_name} SET {column_name} = NULLIF(SUBSTR(TRIM({column_name}), 1, 10), '') "
+                                      f"WHERE {column_name} IS NOT NULL AND LENGTH({column_name}) != 10"))
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
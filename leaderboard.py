@@ -0,0 +1,139 @@
+import bisect
+import heapq
+import threading
+from datetime import date, timedelta
+from sqlalchemy import func
+from databases import db, Marker, Review, UserMarker, MapChange, map_change_ids
+
+""" best places rankings: per clique, markers sorted by the Bayesian average of their reviews ("top") and by their
+recent review activity decayed over time ("trending"). Kept in memory per process and caught up with every review
+write (by any process) through the map change log, like the nearby index """
+
+PRIOR_WEIGHT = 5  # reviews' worth of the average rating every marker starts from
+TRENDING_HALF_LIFE_DAYS = 7
+TRENDING_WINDOW_DAYS = 60  # older reviews weigh less than 1/300 of today's and are left out
+
+
+def bayesian_average(stars_sum, total_reviews, prior_mean):
+    # pulls the average of markers with few reviews towards the mean of all reviews
+    return (PRIOR_WEIGHT * prior_mean + stars_sum) / (PRIOR_WEIGHT + total_reviews)
+
+
+def trending_score(review_days, today):
+    # review_days: [(creation date, number of reviews)], each review counts half as much every half-life
+    return sum(count * 0.5 ** ((today - day).days / TRENDING_HALF_LIFE_DAYS) for day, count in review_days)
+
+
+class Ranking:
+    """ marker ids sorted by score, best first """
+
+    def __init__(self):
+        self.entries = []  # sorted (-score, marker_id)
+        self.scores = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def set(self, marker_id, score):
+        self.remove(marker_id)
+        bisect.insort(self.entries, (-score, marker_id))
+        self.scores[marker_id] = score
+
+    def remove(self, marker_id):
+        score = self.scores.pop(marker_id, None)
+        if score is not None:
+            del self.entries[bisect.bisect_left(self.entries, (-score, marker_id))]
+
+
+class Leaderboard:
+    def __init__(self, change_id, today, prior_mean):
+        self.change_id = change_id  # last map change reflected here
+        self.today = today  # trending scores are decayed to this day
+        self.prior_mean = prior_mean
+        self.cliques = {}  # marker_id -> clique ids
+        self.top = {}  # clique_id -> Ranking
+        self.trending = {}
+
+    def remove(self, marker_id):
+        for clique_id in self.cliques.pop(marker_id, ()):
+            self.top[clique_id].remove(marker_id)
+            self.trending[clique_id].remove(marker_id)
+
+    def update(self, marker_id, clique_ids, top_score, trend):
+        self.remove(marker_id)
+        self.cliques[marker_id] = set(clique_ids)
+        for clique_id in clique_ids:
+            self.top.setdefault(clique_id, Ranking()).set(marker_id, top_score)
+            trending = self.trending.setdefault(clique_id, Ranking())
+            if trend > 0:
+                trending.set(marker_id, trend)
+
+    def ranked(self, kind, clique_ids, limit):
+        """ [(score, marker_id)] of the best markers of the cliques, a marker shared by several cliques listed once """
+        with _lock:  # other requests' catching up updates the rankings in place
+            rankings = [ranking for clique_id, ranking in (self.top if kind == "top" else self.trending).items()
+                        if clique_id in clique_ids]
+            results = []
+            seen = set()
+            for negative_score, marker_id in heapq.merge(*rankings):
+                if marker_id in seen:
+                    continue
+                seen.add(marker_id)
+                results.append((-negative_score, marker_id))
+                if len(results) == limit:
+                    break
+            return results
+
+
+_leaderboard = None
+_lock = threading.RLock()
+
+
+def _load_markers(leaderboard, marker_ids=None):
+    # ratings, cliques and recent reviews of the given markers (all of them when None), markers that no longer
+    # exist, have no clique left or no review are dropped
+    query = db.session.query(Marker.id, Marker.stars_sum, Marker.total_reviews, UserMarker.clique_id) \
+        .join(UserMarker, UserMarker.marker_id == Marker.id).filter(Marker.total_reviews > 0)
+    recent = db.session.query(Review.marker_id, Review.creation_date, func.count(Review.id)) \
+        .filter(Review.creation_date >= leaderboard.today - timedelta(days=TRENDING_WINDOW_DAYS))
+    if marker_ids is not None:
+        query = query.filter(Marker.id.in_(marker_ids))
+        recent = recent.filter(Review.marker_id.in_(marker_ids))
+
+    rows = {}
+    for marker_id, stars_sum, total_reviews, clique_id in query.all():
+        rows.setdefault(marker_id, (stars_sum, total_reviews, set()))[2].add(clique_id)
+    review_days = {}
+    for marker_id, day, count in recent.group_by(Review.marker_id, Review.creation_date).all():
+        review_days.setdefault(marker_id, []).append((day, count))
+
+    for marker_id in (marker_ids or []):
+        if marker_id not in rows:
+            leaderboard.remove(marker_id)
+    for marker_id, (stars_sum, total_reviews, clique_ids) in rows.items():
+        leaderboard.update(marker_id, clique_ids, bayesian_average(stars_sum, total_reviews, leaderboard.prior_mean),
+                           trending_score(review_days.get(marker_id, []), leaderboard.today))
+
+
+def get_leaderboard():
+    """ the process' leaderboard, built on first use and every day after (trending scores decay, the prior mean is
+    refreshed), in between brought up to date with the markers re-rated since by replaying the map change log """
+    global _leaderboard
+    with _lock:
+        settled, latest = map_change_ids()
+        today = date.today()
+        if _leaderboard is None or _leaderboard.today != today:
+            stars_sum, total_reviews = db.session.query(func.sum(Marker.stars_sum), func.sum(Marker.total_reviews)).one()
+            _leaderboard = Leaderboard(settled, today, stars_sum / total_reviews if total_reviews else 0.0)
+            _load_markers(_leaderboard)
+        elif latest > _leaderboard.change_id:
+            changed = [marker_id for (marker_id,) in db.session.query(MapChange.marker_id).filter(
+                MapChange.id > _leaderboard.change_id, MapChange.id <= latest, MapChange.marker_id.isnot(None)
+            ).distinct()]
+            if changed:
+                _load_markers(_leaderboard, changed)
+            _leaderboard.change_id = settled  # what lies above is replayed again next time
+        return _leaderboard
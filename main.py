@@ -1,17 +1,55 @@
-from flask import Flask, jsonify, render_template, request, url_for, redirect, flash, session
+import click
+from flask import Flask, jsonify, render_template, request, url_for, redirect, flash, session, stream_with_context
+from flask.json.provider import DefaultJSONProvider
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import login_user, LoginManager, login_required, current_user, logout_user
-from rapidfuzz import fuzz
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import joinedload
 import os
-from datetime import datetime, date, timedelta
-from collections import Counter
-
-from databases import db, User, Marker, Clique, UserMarker, CliqueUser, Review, Notification, Event, BannedUser
+import time
+import threading
+import json
+import gzip
+import hashlib
+from datetime import date, timedelta
+from collections import defaultdict
+from itertools import chain, islice
+
+from databases import db, User, Marker, Clique, UserMarker, CliqueUser, Review, Notification, Event, BannedUser, Activity, \
+    CliqueScore, map_change_ids, map_change_log_start
 
 from utils import is_valid_password, is_valid_email, delete_user, perform_leave_clique, \
-    delete_user_from_clique, delete_clique_and_contents, assign_clique_colors, delete_review_and_update_marker, delete_marker_and_contents
+    delete_user_from_clique, delete_clique_and_contents, assign_clique_colors, delete_review_and_update_marker, delete_marker_and_contents, \
+    grid_cell, parse_bbox, markers_in_bbox, upgrade_database, WORLD_BBOX, notify_marker_added, notify_marker_changed, \
+    get_clique_versions, map_etag, notify_clique_changed, notify_member_changed, make_map_cursor, \
+    parse_map_cursor, map_scope_digest, map_changes_since, find_duplicate_markers, merge_duplicate_markers, \
+    upcoming_events, sweep_expired_events, prune_map_changes, date_bucket, make_event_cursor, events_after, \
+    adjust_marker_rating, newest_reviews, make_review_cursor, reviews_before, REVIEWS_PREVIEW, record_activity, \
+    marker_clique_ids, add_clique_scores, add_review_score, review_points, MARKER_POINTS
+from clustering import get_cluster_index
+from tiles import tile_cache, is_valid_tile
+from compact import COMPACT_MIMETYPE, encode_compact_features
+from nearby import get_nearby_index
+from leaderboard import get_leaderboard
+from clique_search import get_search_backend
+from map_cache import map_cache
+
+try:
+    import brotli
+except ImportError:  # optional, responses are gzip compressed only without it
+    brotli = None
+
+class JSONProvider(DefaultJSONProvider):
+    # dates go out as 'YYYY-MM-DD', as they were when they were stored as strings, instead of Flask's HTTP dates
+    @staticmethod
+    def default(o):
+        if isinstance(o, date):
+            return o.isoformat()
+        return DefaultJSONProvider.default(o)
+
 
 app = Flask(__name__)
+app.json = JSONProvider(app)
 app.config['SECRET_KEY'] = os.getenv('SECRET_KEY', 'fallback-secret')
 
 # Database configuration
@@ -23,24 +61,50 @@ login_manager = LoginManager()
 login_manager.init_app(app)
 
 
-@login_manager.user_loader
-def load_user(user_id):
-    return db.get_or_404(User, user_id)
+@app.cli.command("upgrade-db")
+def upgrade_db_command():
+    """Create missing tables and columns, and backfill derived data."""
+    upgrade_database()
 
 
-@app.before_request
-def delete_expired_events():
-    # only run the deletion logic for specific route requests involving events
-    if request.endpoint in ['maptest', 'add_event', 'get_user_markers', 'edit_event']:
-        today = date.today()
+@app.cli.command("merge-duplicates")
+def merge_duplicates_command():
+    """Merge the near-duplicate markers of every clique."""
+    merged = merge_duplicate_markers()
+    click.echo(f"Merged {merged} duplicate markers")
 
-        # delete events with a date strictly before today
-        expired_events = Event.query.filter(Event.date < today).all()
 
-        for event in expired_events:
-            db.session.delete(event)
+@app.cli.command("sweep-events")
+def sweep_events_command():
+    """Delete the events dated before today and the old map change log entries (run daily from a timer)."""
+    deleted = sweep_expired_events()
+    click.echo(f"Deleted {deleted} expired events")
+    pruned = prune_map_changes()
+    click.echo(f"Pruned {pruned} map change log entries")
 
-        db.session.commit()
+
+def start_event_sweeper(interval):
+    # in-process alternative to the timer: every worker sweeps each interval seconds, the DELETEs are idempotent
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    sweep_expired_events()
+                    prune_map_changes()
+                except Exception:
+                    app.logger.exception("Expired event sweep failed")
+
+    threading.Thread(target=run, name="event-sweeper", daemon=True).start()
+
+
+if os.getenv("EVENT_SWEEP_INTERVAL"):
+    start_event_sweeper(int(os.getenv("EVENT_SWEEP_INTERVAL")))
+
+
+@login_manager.user_loader
+def load_user(user_id):
+    return db.get_or_404(User, user_id)
 
 
 @app.route('/map_keys.js')
@@ -57,7 +121,268 @@ def maptest():
     if current_user.email == "adminadmin@gmail.com":
         return render_template("master/masterbase.html", name=current_user.name, logged_in=True)
     selected_layer = session.get('selected_layer', 'default')
-    return render_template("user/maptest.html", name=current_user.name, logged_in=True, selected_layer=selected_layer)
+    clique_colors = assign_clique_colors(sorted(cu.clique_id for cu in current_user.cliques))
+    return render_template("user/maptest.html", name=current_user.name, logged_in=True, selected_layer=selected_layer,
+                           clique_colors=clique_colors)
+
+
+def not_modified(etag):
+    """ 304 response if the client already holds this version of the data, otherwise None """
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+def with_etag(response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'  # cacheable, but revalidated against the ETag
+    return response
+
+
+COMPRESS_MIN_SIZE = 1024  # smaller bodies don't gain enough to be worth the CPU
+
+
+def negotiate_encoding():
+    offered = (['br'] if brotli else []) + ['gzip', 'identity']
+    return request.accept_encodings.best_match(offered, default='identity')
+
+
+def compress(body, encoding):
+    if encoding == 'br':
+        return brotli.compress(body, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(body, compresslevel=6)
+    return body
+
+
+def build_map_response(body, headers, etag):
+    response = app.response_class(body)
+    response.headers.update(headers)
+    response.vary.add('Accept')
+    response.vary.add('Accept-Encoding')
+    return with_etag(response, etag)
+
+
+def cached_map_response(etag):
+    hit = map_cache.get(etag)
+    return build_map_response(*hit, etag) if hit else None
+
+
+def map_response(etag, encoding, mimetype, body, clique_ids, headers=None):
+    """ the body compressed for the negotiated encoding, cached under the ETag (which covers the encoding) so the
+    next request for this version of the map reuses the compressed bytes """
+    headers = {'Content-Type': mimetype, **(headers or {})}
+    if encoding != 'identity' and len(body) >= COMPRESS_MIN_SIZE:
+        body = compress(body, encoding)
+        headers['Content-Encoding'] = encoding
+    map_cache.set(etag, body, headers, clique_ids)
+    return build_map_response(body, headers, etag)
+
+
+STREAM_BATCH_SIZE = 500
+STREAM_MIN_MARKERS = 10 * STREAM_BATCH_SIZE  # smaller answers are built in memory, then cached and compressed
+
+
+def batched_rows(query, size=STREAM_BATCH_SIZE):
+    # rows are fetched from the cursor size at a time instead of being loaded all at once
+    rows = iter(query.yield_per(size))
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+def stream_feature_collection(features, batches, to_features):
+    """ GeoJSON FeatureCollection written to the response one batch of rows at a time: the features already at hand
+    (clusters) first, then to_features(batch) for every batch, so memory stays flat whatever the number of markers """
+    def generate():
+        yield '{"type": "FeatureCollection", "features": ['
+        separator = ''
+        for chunk in chain([features], (to_features(batch) for batch in batches)):
+            if chunk:
+                yield separator + ','.join(app.json.dumps(feature) for feature in chunk)
+                separator = ','
+        yield ']}'
+
+    return app.response_class(stream_with_context(generate()), mimetype='application/json')
+
+
+def review_item(review, author):
+    # a review as listed in popups, author is None once the user was deleted
+    return {
+        "stars": review.stars,
+        "commentary": review.commentary,
+        "user": author.name if author else "Deleted User",
+        "user_pic": author.picture if author else "default.jpg"
+    }
+
+
+def markers_details(markers):
+    """ popup data of several markers as seen by the current user: own review and events apart from everyone
+    else's, of whose reviews only the newest few are inlined. Always 4 queries (own reviews, newest reviews, events,
+    their authors), however many markers are passed """
+    marker_ids = [marker.id for marker in markers]
+    own_reviews = Review.query.filter(Review.marker_id.in_(marker_ids), Review.user_id == current_user.id).all() \
+        if marker_ids else []
+    reviews = newest_reviews(marker_ids, REVIEWS_PREVIEW, exclude_user_id=current_user.id)
+    events = Event.query.filter(Event.marker_id.in_(marker_ids), upcoming_events()).all() if marker_ids else []
+
+    author_ids = {r.user_id for r in reviews} | {e.user_id for e in events}
+    authors = {u.id: u for u in User.query.filter(User.id.in_(author_ids)).all()} if author_ids else {}
+
+    def author_field(user_id, field, missing):
+        author = authors.get(user_id)
+        return getattr(author, field) if author else missing
+
+    details = {
+        marker.id: {
+            "description": marker.description or "No description",
+            "average_review": marker.average_review,
+            "total_reviews": marker.total_reviews,
+            "user_review": None,
+            "reviews": [],
+            "reviews_cursor": None,  # set when more reviews than the inlined ones exist, for /marker/<id>/reviews
+            "user_events": [],
+            "events": []
+        }
+        for marker in markers
+    }
+
+    for r in own_reviews:
+        details[r.marker_id]["user_review"] = {
+            "stars": r.stars,
+            "commentary": r.commentary
+        }
+
+    last_inlined = {}
+    for r in reviews:
+        details[r.marker_id]["reviews"].append(review_item(r, authors.get(r.user_id)))
+        last_inlined[r.marker_id] = r
+
+    for marker in markers:
+        marker_details = details[marker.id]
+        other_reviews = marker.total_reviews - (1 if marker_details["user_review"] else 0)
+        # total_reviews counting rows that are gone must not break the popup, there is just nothing to page then
+        if other_reviews > len(marker_details["reviews"]) and marker.id in last_inlined:
+            marker_details["reviews_cursor"] = make_review_cursor(last_inlined[marker.id])
+
+    for e in events:
+        if e.user_id == current_user.id:
+            details[e.marker_id]["user_events"].append({
+                "date": e.date,
+                "time": e.time,
+                "description": e.description,
+                "is_own_event": True
+            })
+        else:
+            details[e.marker_id]["events"].append({
+                "date": e.date,
+                "time": e.time,
+                "description": e.description,
+                "user": author_field(e.user_id, "name", "Deleted User"),
+                "user_pic": author_field(e.user_id, "picture", "default.jpg"),
+                "is_own_event": False
+            })
+
+    return details
+
+
+def marker_details(marker):
+    return markers_details([marker])[marker.id]
+
+
+def slim_marker_features(user_markers, clique_color_map=None):
+    """ map pins without popup data: position, clique styling, rating aggregates and the next event's date.
+    Without a clique_color_map the color is left for the client to fill in """
+    marker_ids = [um.marker_id for um in user_markers]
+    next_events = {
+        marker_id: next_date.isoformat()
+        for marker_id, next_date in db.session.query(Event.marker_id, func.min(Event.date))
+        .filter(Event.marker_id.in_(marker_ids), upcoming_events())
+        .group_by(Event.marker_id)
+    } if marker_ids else {}
+
+    return [{
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [um.marker.long, um.marker.lat]
+        },
+        "properties": {
+            "marker_id": um.marker_id,
+            "average_review": um.marker.average_review,
+            "total_reviews": um.marker.total_reviews,
+            "next_event_date": next_events.get(um.marker_id),
+            "clique_id": um.clique_id,
+            "clique_name": um.clique.name,
+            "clique_color": clique_color_map[um.clique_id] if clique_color_map else None,
+            "icon": um.clique.icon
+        }
+    } for um in user_markers]
+
+
+def full_marker_features(user_markers, clique_color_map):
+    details = markers_details({um.marker for um in user_markers})
+    return [{
+        "type": "Feature",
+        "geometry": {
+            "type": "Point",
+            "coordinates": [um.marker.long, um.marker.lat]
+        },
+        "properties": {
+            **details[um.marker_id],
+            "marker_id": um.marker_id,
+            "clique_id": um.clique_id,
+            "clique_name": um.clique.name,
+            "clique_color": clique_color_map[um.clique_id],
+            "icon": um.clique.icon
+        }
+    } for um in user_markers]
+
+
+def map_delta(since, user_clique_ids, bounds, slim):
+    """ the user's map changes since the cursor: current features of the added or changed markers, tombstones of the
+    deleted ones and the cursor to sync from next. A cursor from another set of cliques (or day), or older than the
+    pruned part of the change log, resets the map """
+    since_id, digest = parse_map_cursor(since)
+    # read before the features, a write landing in between or still uncommitted below until_id is sent again next time
+    settled_id, until_id = map_change_ids()
+    clique_color_map = assign_clique_colors(sorted(user_clique_ids))
+
+    reset = digest != map_scope_digest(user_clique_ids) or since_id < map_change_log_start()
+    deleted = []
+    if reset:
+        markers_query = UserMarker.query.filter(UserMarker.clique_id.in_(user_clique_ids))
+    else:
+        whole_cliques, pairs = map_changes_since(since_id, until_id, user_clique_ids)
+        pairs = {(clique_id, marker_id) for clique_id, marker_id in pairs if clique_id not in whole_cliques}
+
+        marker_ids_by_clique = defaultdict(set)
+        for clique_id, marker_id in pairs:
+            marker_ids_by_clique[clique_id].add(marker_id)
+        pair_conditions = [and_(UserMarker.clique_id == clique_id, UserMarker.marker_id.in_(marker_ids))
+                           for clique_id, marker_ids in marker_ids_by_clique.items()]
+        conditions = pair_conditions + ([UserMarker.clique_id.in_(whole_cliques)] if whole_cliques else [])
+        markers_query = UserMarker.query.filter(or_(*conditions)) if conditions else None
+
+        # markers whose link to the clique is gone, whether or not they were inside the viewport
+        if pairs:
+            existing = set(db.session.query(UserMarker.clique_id, UserMarker.marker_id).filter(or_(*pair_conditions)))
+            deleted = [{"clique_id": clique_id, "marker_id": marker_id} for clique_id, marker_id in sorted(pairs - existing)]
+
+    user_markers = []
+    if markers_query is not None:
+        if bounds:
+            markers_query = markers_query.join(Marker, Marker.id == UserMarker.marker_id).filter(markers_in_bbox(*bounds))
+        user_markers = markers_query.options(joinedload(UserMarker.marker), joinedload(UserMarker.clique)).all()
+
+    return {
+        "cursor": make_map_cursor(settled_id, user_clique_ids),
+        "reset": reset,
+        "features": slim_marker_features(user_markers, clique_color_map) if slim
+        else full_marker_features(user_markers, clique_color_map),
+        "deleted": deleted
+    }
 
 
 # fetch markers in GeoJSON format route
@@ -66,112 +391,416 @@ def maptest():
 def get_user_markers():
     # extract current user markers from database
     user_clique_ids = {cu.clique_id for cu in current_user.cliques}
-    user_markers = UserMarker.query.filter(UserMarker.clique_id.in_(user_clique_ids)).all()
+
+    # Accept: application/x-geocliques-compact selects the packed columnar format over GeoJSON
+    compact = request.accept_mimetypes.best_match(['application/json', COMPACT_MIMETYPE]) == COMPACT_MIMETYPE
+
+    encoding = negotiate_encoding()
+
+    # nothing written to the user's cliques since the client's copy (events are listed from today on)
+    clique_versions = get_clique_versions(user_clique_ids)
+    etag = map_etag(clique_versions, current_user.id, request.query_string, date.today(), compact, encoding)
+    cached = not_modified(etag)
+    if cached:
+        return cached
+
+    # serialized responses are cached under their ETag, which changes with every write to the user's cliques
+    cached = cached_map_response(etag)
+    if cached:
+        return cached
+
+    # full responses carry the cursor to pass as ?since= on the next poll in the X-Map-Cursor header
+    cursor = make_map_cursor(map_change_ids()[0], user_clique_ids)
+    markers_query = UserMarker.query.filter(UserMarker.clique_id.in_(user_clique_ids))
+
+    # optional viewport: only the markers inside ?bbox=minLon,minLat,maxLon,maxLat
+    bbox = request.args.get('bbox')
+    bounds = None
+    if bbox:
+        try:
+            bounds = parse_bbox(bbox)
+        except ValueError:
+            return jsonify({"error": "Invalid bbox, expected minLon,minLat,maxLon,maxLat"}), 400
+        markers_query = markers_query.join(Marker, Marker.id == UserMarker.marker_id).filter(markers_in_bbox(*bounds))
+
+    # ?since=<cursor>: only the markers added, changed or deleted since the client's last sync
+    since = request.args.get('since')
+    if since is not None:
+        if request.args.get('zoom') is not None:
+            return jsonify({"error": "since cannot be combined with zoom, clusters are not synced incrementally"}), 400
+        try:
+            delta = map_delta(since, user_clique_ids, bounds, request.args.get('slim') == '1')
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+        return with_etag(jsonify(delta), etag)
+
     clique_ids = sorted(user_clique_ids)
     clique_color_map = assign_clique_colors(clique_ids)
 
+    # optional ?zoom=: overlapping markers are merged into clusters, only the rest are serialized in full
+    zoom = request.args.get('zoom', type=int)
     features = []
-    for um in user_markers:
-        marker = um.marker
-        clique = db.session.get(Clique, um.clique_id)
+    if zoom is not None:
+        cliques_by_id = {c.id: c for c in Clique.query.filter(Clique.id.in_(clique_ids)).all()}
+        expanded = []
+        for clique_id in clique_ids:
+            clusters, marker_ids = get_cluster_index(clique_id).query(zoom, bounds or WORLD_BBOX)
+            for cluster in clusters:
+                cluster["properties"].update({
+                    "clique_id": clique_id,
+                    "clique_name": cliques_by_id[clique_id].name,
+                    "clique_color": clique_color_map[clique_id],
+                    "icon": cliques_by_id[clique_id].icon
+                })
+            features.extend(clusters)
+            if marker_ids:
+                expanded.append(and_(UserMarker.clique_id == clique_id, UserMarker.marker_id.in_(marker_ids)))
+
+        markers_query = UserMarker.query.filter(or_(*expanded)) if expanded else None
+
+    if markers_query is not None:
+        markers_query = markers_query.options(joinedload(UserMarker.marker), joinedload(UserMarker.clique))
+
+    # ?slim=1: only what the map pin needs, the popup fetches the rest from /marker/<id>/details
+    slim = request.args.get('slim') == '1' or compact
+
+    def to_features(user_markers):
+        if slim:
+            return slim_marker_features(user_markers, clique_color_map)
+        return full_marker_features(user_markers, clique_color_map)
+
+    # ?stream=1: a FeatureCollection serialized batch by batch instead of a list built in memory
+    if request.args.get('stream') == '1' and not compact:
+        batches = batched_rows(markers_query) if markers_query is not None else []
+        response = with_etag(stream_feature_collection(features, batches, to_features), etag)
+        response.headers['X-Map-Cursor'] = cursor
+        response.vary.add('Accept')
+        return response
+
+    features.extend(to_features(markers_query.all() if markers_query is not None else []))
+    if compact:
+        body, mimetype = encode_compact_features(features), COMPACT_MIMETYPE
+    else:
+        body, mimetype = jsonify(features).get_data(), 'application/json'
+    return map_response(etag, encoding, mimetype, body, user_clique_ids, {'X-Map-Cursor': cursor})
 
-        # extract current user reviews (if any)
-        review = Review.query.filter_by(marker_id=marker.id, user_id=current_user.id).first()
-        user_review = None
-        if review:
-            user_review = {
-                "stars": review.stars,
-                "commentary": review.commentary
-            }
 
-        # extract all other reviews
-        all_reviews = Review.query.filter(Review.marker_id == marker.id, Review.user_id != current_user.id).all()
-        other_reviews = [
-            {
-                "stars": r.stars,
-                "commentary": r.commentary,
-                "user": db.session.get(User, r.user_id).name,
-                "user_pic": db.session.get(User, r.user_id).picture
-            }
-            for r in all_reviews
-        ]
+MAX_DETAILS_BATCH = 100
 
-        # extract current user events (if any)
-        all_user_events = Event.query.filter_by(marker_id=marker.id, user_id=current_user.id).all()
-        user_events = [
-            {
-                "date": e.date,
-                "time": e.time,
-                "description": e.description,
-                "is_own_event": True
-            }
-            for e in all_user_events
-        ]
 
-        # extract all other events
-        all_events = Event.query.filter(Event.marker_id == marker.id, Event.user_id != current_user.id).all()
-        other_events = [
-            {
-                "date": e.date,
-                "time": e.time,
-                "description": e.description,
-                "user": db.session.get(User, e.user_id).name,
-                "user_pic": db.session.get(User, e.user_id).picture,
-                "is_own_event": False
-            }
-            for e in all_events
-        ]
+@app.route('/marker/<int:marker_id>/details', methods=['GET'])
+@login_required
+def get_marker_details(marker_id):
+    user_clique_ids = {cu.clique_id for cu in current_user.cliques}
+    link = UserMarker.query.filter(UserMarker.marker_id == marker_id, UserMarker.clique_id.in_(user_clique_ids)).first()
+    if not link:
+        return jsonify({"error": "Marker not found"}), 404
 
-        features.append({
-            "type": "Feature",
-            "geometry": {
-                "type": "Point",
-                "coordinates": [marker.long, marker.lat]
-            },
-            "properties": {
-                "description": marker.description or "No description",
-                "marker_id": marker.id,
-                "average_review": marker.average_review,
-                "total_reviews": marker.total_reviews,
-                "user_review": user_review,
-                "reviews": other_reviews,
-                "user_events": user_events,
-                "events": other_events,
-                "clique_id": um.clique_id,
-                "clique_name": clique.name,
-                "clique_color": clique_color_map[um.clique_id],
-                "icon": clique.icon
-            }
-        })
+    return jsonify(marker_details(link.marker))
+
+
+@app.route('/markers/details', methods=['GET'])
+@login_required
+def get_markers_details():
+    try:
+        marker_ids = {int(mid) for mid in request.args.get('ids', '').split(',') if mid.strip()}
+    except ValueError:
+        return jsonify({"error": "ids must be a comma separated list of marker ids"}), 400
+    if len(marker_ids) > MAX_DETAILS_BATCH:
+        return jsonify({"error": f"At most {MAX_DETAILS_BATCH} markers per request"}), 400
 
+    # markers outside the user's cliques are left out of the response
+    user_clique_ids = {cu.clique_id for cu in current_user.cliques}
+    markers = Marker.query.join(UserMarker, UserMarker.marker_id == Marker.id).filter(
+        Marker.id.in_(marker_ids), UserMarker.clique_id.in_(user_clique_ids)
+    ).distinct().all() if marker_ids else []
+
+    return jsonify({str(marker_id): d for marker_id, d in markers_details(markers).items()})
+
+
+REVIEWS_PAGE_SIZE = 20
+MAX_REVIEWS_PAGE = 100
+
+
+@app.route('/marker/<int:marker_id>/reviews', methods=['GET'])
+@login_required
+def get_marker_reviews(marker_id):
+    """ the marker's reviews newest first, past the ones already listed: pass the reviews_cursor of the marker's
+    popup data, then each page's next_cursor, as ?cursor= """
+    is_master = current_user.email == "adminadmin@gmail.com"
+    if not is_master:
+        user_clique_ids = {cu.clique_id for cu in current_user.cliques}
+        link = UserMarker.query.filter(UserMarker.marker_id == marker_id, UserMarker.clique_id.in_(user_clique_ids)).first()
+        if not link:
+            return jsonify({"error": "Marker not found"}), 404
+
+    limit = request.args.get('limit', default=REVIEWS_PAGE_SIZE, type=int)
+    if not 1 <= limit <= MAX_REVIEWS_PAGE:
+        return jsonify({"error": f"limit must be between 1 and {MAX_REVIEWS_PAGE}"}), 400
+
+    # users see their own review apart, as in the popup
+    query = Review.query.filter(Review.marker_id == marker_id)
+    if not is_master:
+        query = query.filter(Review.user_id != current_user.id)
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            query = query.filter(reviews_before(cursor))
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+
+    # one row past the page tells whether there is a next one
+    reviews = query.options(joinedload(Review.user)) \
+        .order_by(Review.creation_date.desc(), Review.id.desc()).limit(limit + 1).all()
+    page = reviews[:limit]
+
+    return jsonify({
+        "reviews": [dict(review_item(r, r.user), date=r.creation_date) for r in page],
+        "next_cursor": make_review_cursor(page[-1]) if len(reviews) > limit else None
+    })
+
+
+MAX_NEARBY = 100
+
+
+@app.route('/markers/nearby', methods=['GET'])
+@login_required
+def get_nearby_markers():
+    lat = request.args.get('lat', type=float)
+    lon = request.args.get('lon', type=float)
+    k = request.args.get('k', default=10, type=int)
+    radius_m = request.args.get('radius_m', type=float)
+
+    if lat is None or lon is None or not (-90 <= lat <= 90 and -180 <= lon <= 180):
+        return jsonify({"error": "lat and lon must be valid coordinates"}), 400
+    if not 1 <= k <= MAX_NEARBY:
+        return jsonify({"error": f"k must be between 1 and {MAX_NEARBY}"}), 400
+    if radius_m is not None and not radius_m > 0:
+        return jsonify({"error": "radius_m must be positive"}), 400
+
+    # the k closest markers of the user's cliques, as slim features nearest first
+    user_clique_ids = {cu.clique_id for cu in current_user.cliques}
+    distances = {marker_id: distance for distance, marker_id in
+                 get_nearby_index().nearest(lat, lon, k, user_clique_ids, radius_m)}
+    user_markers = UserMarker.query.filter(
+        UserMarker.marker_id.in_(distances), UserMarker.clique_id.in_(user_clique_ids)
+    ).options(joinedload(UserMarker.marker), joinedload(UserMarker.clique)).all() if distances else []
+
+    features = slim_marker_features(user_markers, assign_clique_colors(sorted(user_clique_ids)))
+    for feature in features:
+        feature["properties"]["distance_m"] = round(distances[feature["properties"]["marker_id"]], 1)
+    features.sort(key=lambda f: (f["properties"]["distance_m"], f["properties"]["clique_id"]))
     return jsonify(features)
 
 
-@app.route('/clique-geojson/<int:clique_id>', methods=['GET'])
+LEADERBOARD_SIZE = 20
+MAX_LEADERBOARD = 100
+
+
+@app.route('/leaderboard', methods=['GET'])
 @login_required
-def get_clique_markers(clique_id):
-    if current_user.email != "adminadmin@gmail.com":
-        return jsonify({"error": "Unauthorized"}), 403
+def get_leaderboard_markers():
+    """ best places of the user's cliques (or of ?clique_id=), as slim features best first. ?kind=top ranks by the
+    Bayesian average of the reviews, ?kind=trending by recent reviews """
+    kind = request.args.get('kind', 'top')
+    if kind not in ("top", "trending"):
+        return jsonify({"error": "kind must be top or trending"}), 400
+    limit = request.args.get('limit', default=LEADERBOARD_SIZE, type=int)
+    if not 1 <= limit <= MAX_LEADERBOARD:
+        return jsonify({"error": f"limit must be between 1 and {MAX_LEADERBOARD}"}), 400
+
+    user_clique_ids = {cu.clique_id for cu in current_user.cliques}
+    clique_id = request.args.get('clique_id', type=int)
+    if clique_id is not None:
+        if clique_id not in user_clique_ids:
+            return jsonify({"error": "Clique not found"}), 404
+        user_clique_ids = {clique_id}
+
+    ranked = get_leaderboard().ranked(kind, user_clique_ids, limit)
+    scores = {marker_id: score for score, marker_id in ranked}
+    user_markers = UserMarker.query.filter(
+        UserMarker.marker_id.in_(scores), UserMarker.clique_id.in_(user_clique_ids)
+    ).options(joinedload(UserMarker.marker), joinedload(UserMarker.clique)).order_by(UserMarker.clique_id).all() \
+        if scores else []
+
+    # a marker shared by several of the cliques is listed once, under the first of them
+    features = {}
+    for feature in slim_marker_features(user_markers, assign_clique_colors(sorted(user_clique_ids))):
+        marker_id = feature["properties"]["marker_id"]
+        if marker_id not in features:
+            feature["properties"]["score"] = round(scores[marker_id], 3)
+            features[marker_id] = feature
+    return jsonify([features[marker_id] for _, marker_id in ranked if marker_id in features])
+
+
+EVENTS_PAGE_SIZE = 50
+MAX_EVENTS_PAGE = 200
+
+
+@app.route('/events', methods=['GET'])
+@login_required
+def get_events():
+    """ agenda of the user's cliques: events between ?from= (default today) and ?to= (inclusive, optional), ordered
+    by date and time. Pages are chained by passing the response's next_cursor back as ?cursor= """
+    try:
+        start = date.fromisoformat(request.args['from']) if request.args.get('from') else date.today()
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+    except ValueError:
+        return jsonify({"error": "from and to must be dates formatted as YYYY-MM-DD"}), 400
+    if end is not None and end < start:
+        return jsonify({"error": "to must not be before from"}), 400
+
+    limit = request.args.get('limit', default=EVENTS_PAGE_SIZE, type=int)
+    if not 1 <= limit <= MAX_EVENTS_PAGE:
+        return jsonify({"error": f"limit must be between 1 and {MAX_EVENTS_PAGE}"}), 400
+
+    clique_ids = {cu.clique_id for cu in current_user.cliques}
+    clique_id = request.args.get('clique_id', type=int)
+    if clique_id is not None:
+        if clique_id not in clique_ids:
+            return jsonify({"error": "Clique not found"}), 404
+        clique_ids = {clique_id}
+
+    # past events are gone for every other read too, they only wait for the sweeper
+    query = Event.query.filter(Event.clique_id.in_(clique_ids), Event.date >= start, upcoming_events())
+    if end is not None:
+        query = query.filter(Event.date <= end)
+
+    cursor = request.args.get('cursor')
+    if cursor:
+        try:
+            query = query.filter(events_after(cursor))
+        except ValueError:
+            return jsonify({"error": "Invalid cursor"}), 400
+
+    # one row past the page tells whether there is a next one
+    events = query.options(joinedload(Event.marker), joinedload(Event.clique), joinedload(Event.user)) \
+        .order_by(Event.date, Event.time, Event.id).limit(limit + 1).all() if clique_ids else []
+    page = events[:limit]
+
+    return jsonify({
+        "events": [{
+            "id": e.id,
+            "date": e.date,
+            "time": e.time,
+            "description": e.description,
+            "marker_id": e.marker_id,
+            "marker_title": e.marker.description or "Untitled Marker",
+            "clique_id": e.clique_id,
+            "clique_name": e.clique.name,
+            "user": e.user.name if e.user else "Deleted User",
+            "is_own_event": e.user_id == current_user.id
+        } for e in page],
+        "next_cursor": make_event_cursor(page[-1]) if len(events) > limit else None
+    })
+
+
+def render_clique_tile(clique_id, z, x, y):
+    """ the clique's clusters and slim markers inside one tile, as the comma separated features of a JSON array """
+    clusters, marker_ids = get_cluster_index(clique_id).query_tile(z, x, y)
+    features = []
+
+    if clusters:
+        clique = db.session.get(Clique, clique_id)
+        for cluster in clusters:
+            cluster["properties"].update({
+                "clique_id": clique_id,
+                "clique_name": clique.name,
+                "clique_color": None,
+                "icon": clique.icon
+            })
+        features.extend(clusters)
+
+    if marker_ids:
+        user_markers = UserMarker.query.filter(UserMarker.clique_id == clique_id, UserMarker.marker_id.in_(marker_ids)) \
+            .options(joinedload(UserMarker.marker), joinedload(UserMarker.clique)).all()
+        features.extend(slim_marker_features(user_markers))
+
+    return json.dumps(features, separators=(',', ':'))[1:-1].encode()
+
+
+def cached_clique_tile(clique_id, z, x, y, as_of, compact):
+    """ (sha, body) of the clique's tile from the tile cache, rendered and cached if missing. The compact block is
+    packed from the GeoJSON one, an empty tile has an empty body in both formats """
+    cached = tile_cache.get((clique_id, z, x, y, "compact" if compact else "geojson"))
+    if cached is not None:
+        return cached
+
+    cached = tile_cache.get((clique_id, z, x, y, "geojson"))
+    if cached is None:
+        body = render_clique_tile(clique_id, z, x, y)
+        cached = tile_cache.put((clique_id, z, x, y, "geojson"), body, as_of), body
+    if not compact:
+        return cached
 
-    user_markers = UserMarker.query.filter_by(clique_id=clique_id).all()
+    body = encode_compact_features(json.loads(b'[' + cached[1] + b']')) if cached[1] else b''
+    return tile_cache.put((clique_id, z, x, y, "compact"), body, as_of), body
+
+
+@app.route('/tiles/<int:z>/<int:x>/<int:y>.geojson', methods=['GET'])
+@login_required
+def get_marker_tile(z, x, y):
+    if not is_valid_tile(z, x, y):
+        return jsonify({"error": "Tile not found"}), 404
+
+    # Accept: application/x-geocliques-compact selects the packed columnar format of compact.py (decoded by
+    # universal.js), one block per clique, over GeoJSON
+    compact = request.accept_mimetypes.best_match(['application/geo+json', COMPACT_MIMETYPE]) == COMPACT_MIMETYPE
+
+    # one cached tile per clique and format, so members of the same clique share them, writes in any worker drop
+    # the tiles around the changed markers once the cache replays them
+    bodies = []
+    shas = []
+    as_of = tile_cache.catch_up()
+    for clique_id in sorted(cu.clique_id for cu in current_user.cliques):
+        sha, body = cached_clique_tile(clique_id, z, x, y, as_of, compact)
+        shas.append(sha)
+        if body:
+            bodies.append(body)
+
+    if compact:
+        response = app.response_class(b''.join(bodies), mimetype=COMPACT_MIMETYPE)
+        shas.append('compact')  # empty tiles have the same sha in both formats
+    else:
+        response = app.response_class(b'{"type":"FeatureCollection","features":[' + b','.join(bodies) + b']}',
+                                      mimetype='application/geo+json')
+    with_etag(response, hashlib.sha1(','.join(shas).encode()).hexdigest())
+    response.vary.add('Accept')
+    response.vary.add('Cookie')
+    return response.make_conditional(request)
+
+
+def clique_marker_features(user_markers):
+    """ the admin map's features: each marker with its newest reviews and its events """
+    # reviews, events and their authors for all the markers at once
+    marker_ids = [um.marker_id for um in user_markers]
+    reviews_by_marker = defaultdict(list)
+    events_by_marker = defaultdict(list)
+    if marker_ids:
+        for r in newest_reviews(marker_ids, REVIEWS_PREVIEW):
+            reviews_by_marker[r.marker_id].append(r)
+        for e in Event.query.filter(Event.marker_id.in_(marker_ids), upcoming_events()).all():
+            events_by_marker[e.marker_id].append(e)
+
+    author_ids = {r.user_id for rs in reviews_by_marker.values() for r in rs} | \
+                 {e.user_id for es in events_by_marker.values() for e in es}
+    author_names = dict(db.session.query(User.id, User.name).filter(User.id.in_(author_ids)).all()) if author_ids else {}
 
     features = []
     for um in user_markers:
         marker = um.marker
-        all_reviews = Review.query.filter_by(marker_id=marker.id).all()
         review_data = [{
-            "user": db.session.get(User, r.user_id).name,
+            "user": author_names.get(r.user_id, "Deleted User"),
             "stars": r.stars,
             "commentary": r.commentary or ""
-        } for r in all_reviews]
+        } for r in reviews_by_marker[marker.id]]
 
-        all_events = Event.query.filter_by(marker_id=marker.id).all()
         events_data = [{
-            "user": db.session.get(User, e.user_id).name,
+            "user": author_names.get(e.user_id, "Deleted User"),
             "date": e.date,
             "time": e.time,
             "description": e.description
-        } for e in all_events]
+        } for e in events_by_marker[marker.id]]
 
         features.append({
             "type": "Feature",
@@ -180,15 +809,57 @@ def get_clique_markers(clique_id):
                 "coordinates": [marker.long, marker.lat]
             },
             "properties": {
+                "marker_id": marker.id,
                 "marker_title": marker.description or "Untitled Marker",
                 "average_review": marker.average_review,
                 "total_reviews": marker.total_reviews,
                 "reviews": review_data,
+                "reviews_cursor": make_review_cursor(reviews_by_marker[marker.id][-1])
+                if marker.total_reviews > len(review_data) and review_data else None,
                 "events": events_data
             }
         })
 
-    return jsonify(features)
+    return features
+
+
+@app.route('/clique-geojson/<int:clique_id>', methods=['GET'])
+@login_required
+def get_clique_markers(clique_id):
+    if current_user.email != "adminadmin@gmail.com":
+        return jsonify({"error": "Unauthorized"}), 403
+
+    encoding = negotiate_encoding()
+    clique_versions = get_clique_versions([clique_id])
+    etag = map_etag(clique_versions, request.query_string, date.today(), encoding)
+    cached = not_modified(etag) or cached_map_response(etag)
+    if cached:
+        return cached
+
+    markers_query = UserMarker.query.filter_by(clique_id=clique_id)
+    features = []
+
+    # optional ?zoom=&bbox=: same clustering as the users' map
+    zoom = request.args.get('zoom', type=int)
+    if zoom is not None:
+        try:
+            bounds = parse_bbox(request.args['bbox']) if request.args.get('bbox') else WORLD_BBOX
+        except ValueError:
+            return jsonify({"error": "Invalid bbox, expected minLon,minLat,maxLon,maxLat"}), 400
+        clusters, marker_ids = get_cluster_index(clique_id).query(zoom, bounds)
+        features.extend(clusters)
+        markers_query = markers_query.filter(UserMarker.marker_id.in_(marker_ids))
+        marker_count = len(marker_ids)
+    else:
+        marker_count = markers_query.count()
+
+    # only large answers are streamed (uncached and uncompressed), ?stream=1 forces it
+    markers_query = markers_query.options(joinedload(UserMarker.marker))
+    if request.args.get('stream') == '1' or marker_count >= STREAM_MIN_MARKERS:
+        return with_etag(stream_feature_collection(features, batched_rows(markers_query), clique_marker_features), etag)
+
+    features.extend(clique_marker_features(markers_query.all()))
+    return map_response(etag, encoding, 'application/json', jsonify(features).get_data(), [clique_id])
 
 
 @app.route('/add-marker', methods=['POST'])
@@ -214,8 +885,40 @@ def add_marker():
         if clique_id not in user_clique_ids:
             return jsonify({"success": False, "message": "You are not a member of this clique."}), 403
 
-        new_marker = Marker(lat=latitude, long=longitude, description=title, total_reviews=1,
-                            average_review=float(rating))
+        # merge_into=<marker id>: the user chose to review the existing marker instead of adding a copy
+        merge_into = data.get('merge_into')
+        if merge_into is not None:
+            try:
+                merge_into = int(merge_into)
+            except (TypeError, ValueError):
+                return jsonify({"success": False, "message": "Invalid marker to merge into."}), 400
+            link = UserMarker.query.filter_by(marker_id=merge_into, clique_id=clique_id).first()
+            if not link:
+                return jsonify({"success": False, "message": "Marker not found in this clique."}), 400
+            if Review.query.filter_by(marker_id=link.marker_id, user_id=current_user.id).first():
+                return jsonify({"success": False, "message": "You have already reviewed this marker."}), 400
+            add_review(link.marker, rating, commentary)
+            db.session.commit()
+            return jsonify({"success": True, "message": "Review added to the existing marker!"}), 200
+
+        # the same place already in the clique: offer to merge unless the user confirmed it is a different one
+        if not data.get('allow_duplicate'):
+            duplicates = find_duplicate_markers(float(latitude), float(longitude), title, clique_id)
+            if duplicates:
+                return jsonify({
+                    "success": False,
+                    "message": "A similar marker already exists nearby.",
+                    "duplicates": [{
+                        "marker_id": marker.id,
+                        "title": marker.description,
+                        "distance_m": round(distance, 1),
+                        "average_review": marker.average_review,
+                        "total_reviews": marker.total_reviews
+                    } for distance, marker in duplicates]
+                }), 409
+
+        new_marker = Marker(lat=latitude, long=longitude, description=title, total_reviews=1, stars_sum=rating,
+                            average_review=float(rating), grid_cell=grid_cell(float(latitude), float(longitude)))
 
         db.session.add(new_marker)
         db.session.flush()  # get marker.id before commit
@@ -225,7 +928,7 @@ def add_marker():
             user_id=current_user.id,
             marker_id=new_marker.id,
             clique_id=clique_id,
-            creation_date=datetime.today().strftime('%Y-%m-%d')
+            creation_date=date.today()
         )
         db.session.add(user_marker)
 
@@ -233,12 +936,17 @@ def add_marker():
         new_review = Review(
             stars=rating,
             commentary=commentary,
+            score=review_points(commentary),
             marker_id=new_marker.id,
             user_id=current_user.id,
-            creation_date=datetime.today().strftime('%Y-%m-%d')
+            creation_date=date.today()
         )
         db.session.add(new_review)
 
+        notify_marker_added(clique_id, new_marker)
+        add_clique_scores({(clique_id, current_user.id): MARKER_POINTS + new_review.score})
+        record_activity("marker", [clique_id], current_user, new_marker)
+        record_activity("review", [clique_id], current_user, new_marker, review=new_review)
         db.session.commit()
 
         return jsonify({"success": True, "message": "Marker added successfully!"}), 201
@@ -273,17 +981,33 @@ def update_review(marker_id):
     new_stars = int(request.form.get("stars"))
     new_comment = request.form.get("commentary", "").strip()
 
-    # update marker average and total
-    total = marker.total_reviews
-    new_avg = ((marker.average_review * total) - review.stars + new_stars) / total
-    marker.average_review = round(new_avg, 2)
-
+    new_score = review_points(new_comment)
+    adjust_marker_rating(marker, new_stars - review.stars)
+    add_review_score(marker.id, current_user.id, new_score - review.score)
     review.stars = new_stars
     review.commentary = new_comment
+    review.score = new_score
+    notify_marker_changed(marker)
     db.session.commit()
     return redirect(url_for(next))
 
 
+def add_review(marker, stars, commentary):
+    adjust_marker_rating(marker, stars, 1)
+    review = Review(
+        stars=stars,
+        commentary=commentary,
+        score=review_points(commentary),
+        marker_id=marker.id,
+        user_id=current_user.id,
+        creation_date=date.today()
+    )
+    db.session.add(review)
+    notify_marker_changed(marker)
+    add_review_score(marker.id, current_user.id, review.score)
+    record_activity("review", marker_clique_ids(marker.id), current_user, marker, review=review)
+
+
 @app.route('/rate-marker/<int:marker_id>', methods=['POST'])
 @login_required
 def rate_marker(marker_id):
@@ -299,19 +1023,7 @@ def rate_marker(marker_id):
     if existing_review:
         return jsonify({"success": False, "message": "You have already reviewed this marker."}), 400
 
-    # update marker average and total
-    new_avg = ((marker.average_review * marker.total_reviews) + stars) / (marker.total_reviews + 1)
-    marker.total_reviews += 1
-    marker.average_review = round(new_avg, 2)
-
-    review = Review(
-        stars=stars,
-        commentary=commentary,
-        marker_id=marker_id,
-        user_id=current_user.id,
-        creation_date=datetime.today().strftime('%Y-%m-%d')
-    )
-    db.session.add(review)
+    add_review(marker, stars, commentary)
     db.session.commit()
 
     return jsonify({"success": True, "message": "Review added!"})
@@ -344,23 +1056,31 @@ def select_layer():
 @login_required
 def add_event(marker_id, clique_id):
     if request.method == "POST":
-        date = request.form.get("date")
-        time = request.form.get("time")
+        event_date = request.form.get("date")
+        event_time = request.form.get("time")
         description = request.form.get("description")
 
-        if not date or not time or not description:
-            return redirect(url_for("add_event"))
+        if not event_date or not event_time or not description:
+            return redirect(url_for("add_event", marker_id=marker_id, clique_id=clique_id))
+        try:
+            event_date = date.fromisoformat(event_date)
+        except ValueError:
+            return redirect(url_for("add_event", marker_id=marker_id, clique_id=clique_id))
 
         new_event = Event(
-            date=date,
-            time=time,
+            date=event_date,
+            time=event_time,
             description=description,
             marker_id=marker_id,
             clique_id=clique_id,
             user_id=current_user.id
         )
 
+        marker = db.session.get(Marker, marker_id)
         db.session.add(new_event)
+        notify_marker_changed(marker)
+        record_activity("event", [clique_id], current_user, marker, commentary=description, event_date=event_date,
+                        event_time=event_time)
         db.session.commit()
         return redirect(url_for('maptest'))
 
@@ -372,7 +1092,7 @@ def add_event(marker_id, clique_id):
 @login_required
 def edit_event(marker_id, clique_id):
     all_user_events = Event.query.filter(Event.marker_id == marker_id, Event.user_id == current_user.id,
-                                         Event.clique_id == clique_id).all()
+                                         Event.clique_id == clique_id, upcoming_events()).all()
     marker = Marker.query.filter(Marker.id == marker_id).first()
     clique = Clique.query.filter(Clique.id == clique_id).first()
     return render_template('user/edit_events.html', events=all_user_events, clique=clique, marker=marker,
@@ -384,6 +1104,7 @@ def edit_event(marker_id, clique_id):
 @login_required
 def update_event(event_id):
     event = Event.query.get_or_404(event_id)
+    marker = event.marker
     action = request.form.get("action")
     next = request.form.get("next")  # maptest route default
 
@@ -391,6 +1112,7 @@ def update_event(event_id):
 
         if action == "delete":
             db.session.delete(event)
+            notify_marker_changed(marker)
             db.session.commit()
 
             if current_user.email == "adminadmin@gmail.com":
@@ -402,7 +1124,11 @@ def update_event(event_id):
                 return redirect(url_for('edit_event', marker_id=event.marker_id, clique_id=event.clique_id))
 
         else:
-            event_date = request.form['date']
+            try:
+                event_date = date.fromisoformat(request.form['date'])
+            except ValueError:
+                flash("Invalid event date.")
+                return redirect(request.referrer or url_for('maptest'))
             event_time = request.form['time']
             event_description = request.form['description']
 
@@ -410,6 +1136,7 @@ def update_event(event_id):
             event.time = event_time
             event.description = event_description
 
+            notify_marker_changed(marker)
             db.session.commit()
 
             if next == 'settings':
@@ -426,6 +1153,7 @@ def update_icon(clique_id):
     if request.method == 'POST':
         new_icon = request.form.get("selectedIcon")
         clique.icon = new_icon
+        notify_clique_changed(clique_id)
 
         db.session.commit()
 
@@ -443,6 +1171,7 @@ def update_clique_type(clique_id):
 
         if new_visibility in ['Private', 'Public', 'Protected']:
             clique.visibility = new_visibility
+            notify_clique_changed(clique.id)
 
             db.session.commit()
 
@@ -570,7 +1299,7 @@ def settings():
                 "stars": r.stars,
             })
 
-    all_events = Event.query.filter_by(user_id=current_user.id).all()
+    all_events = Event.query.filter(Event.user_id == current_user.id, upcoming_events()).all()
     events_data = []
 
     # get clique and marker info to each event object
@@ -642,6 +1371,7 @@ def update_user():
 
     current_user.name = new_name
     current_user.email = new_email
+    notify_member_changed(current_user)
     db.session.commit()
 
     return redirect(url_for("settings"))
@@ -714,12 +1444,14 @@ def update_profile_pic(user_id):
         avatar_filename = request.form.get('selected_avatar')
 
         user.picture = avatar_filename
+        notify_member_changed(user)
         db.session.commit()
 
         return redirect(url_for('settings'))
 
     if action == "delete":
         user.picture = 'default.jpg'
+        notify_member_changed(user)
         db.session.commit()
 
         return redirect(url_for('settings'))
@@ -727,6 +1459,9 @@ def update_profile_pic(user_id):
 
 # CLIQUE FUNCTIONS
 """ functions relating to creating, searching, joining, and leaving cliques"""
+FEED_PAGE_SIZE = 20
+
+
 @app.route('/feed')
 @login_required
 def feed():
@@ -744,112 +1479,40 @@ def feed():
             "visibility": clique.visibility
         })
 
-    week_ago = (datetime.today() - timedelta(days=7)).strftime('%Y-%m-%d')
-
-    recent_markers = UserMarker.query.filter(
-        UserMarker.clique_id.in_(user_clique_ids),
-        UserMarker.creation_date >= week_ago
-    ).all()
-
-    marker_updates = []
-    for um in recent_markers:
-        creator = db.session.get(User, um.user_id)
-        marker_updates.append({
-            "type": "marker",
-            "date": um.creation_date,
-            "clique_name": db.session.get(Clique, um.clique_id).name,
-            "marker_name": um.marker.description or "Unnamed Marker",
-            "description": um.marker.description or "",
-            "user_name": creator.name if creator else "Deleted User",
-            "user_pic": creator.picture if creator else "default.jpg"
-        })
-
-    marker_ids = [um.marker_id for um in UserMarker.query.filter(UserMarker.clique_id.in_(user_clique_ids)).all()]
-    recent_reviews = Review.query.filter(
-        Review.creation_date >= week_ago,
-        Review.marker_id.in_(marker_ids)
-    ).all()
-
-    review_updates = []
-    for r in recent_reviews:
-        marker = db.session.get(Marker, r.marker_id)
-        any_link = UserMarker.query.filter_by(marker_id=r.marker_id).first()
-        if not any_link:
-            continue
-        clique = db.session.get(Clique, any_link.clique_id)
-        creator = db.session.get(User, r.user_id)
-
-        review_updates.append({
-            "type": "review",
-            "date": r.creation_date,
-            "clique_name": clique.name,
-            "marker_name": marker.description or "Unnamed Marker",
-            "stars": r.stars,
-            "commentary": r.commentary,
-            "user_name": creator.name if creator else "Deleted User",
-            "user_pic": creator.picture if creator else "default.jpg"
-        })
-
-    all_updates = marker_updates + review_updates
-    all_updates.sort(key=lambda x: x["date"], reverse=True)  # most recent to oldest
-    all_updates = all_updates[:20]
-
-    scoreboard_data = []
-
-    for link in user_clique_links:
-        clique_id = link.clique_id
-        clique = db.session.get(Clique, clique_id)
-        members = CliqueUser.query.filter_by(clique_id=clique_id).all()
-        scores = {}
-
-        for member in members:
-            user = db.session.get(User, member.user_id)
-            user_score = 0
-
-            # reviews
-            marker_ids = [um.marker_id for um in UserMarker.query.filter_by(clique_id=clique_id).all()]
-            reviews = Review.query.filter(
-                Review.user_id == user.id,
-                Review.marker_id.in_(marker_ids)
-            ).all()
-
-            for r in reviews:
-                word_count = len(r.commentary.strip().split()) if r.commentary else 0
-                if word_count <= 3 or word_count > 40:
-                    user_score += 1
-                elif word_count <= 7 or word_count > 35:
-                    user_score += 2
-                elif word_count <= 10 or word_count > 30:
-                    user_score += 3
-                elif word_count <= 15 or word_count > 25:
-                    user_score += 4
-                elif word_count <= 25:
-                    user_score += 5
-
-            # markers (each marker gives +2)
-            marker_count = UserMarker.query.filter_by(clique_id=clique_id, user_id=user.id).count()
-            user_score += marker_count * 2
-
-            scores[user.id] = (user_score, user.name)
-
-        # sort by score descending
-        sorted_users = sorted(scores.items(), key=lambda x: x[1][0], reverse=True)
-        ranking = [
-            {"rank": i + 1, "user_id": uid, "name": scores[uid][1]}
-            for i, (uid, _) in enumerate(sorted_users)
-        ]
-
-        scoreboard_data.append({
-            "clique_name": clique.name,
-            "ranking": ranking
-        })
+    # newest first, ?before=<activity id> pages back through older entries
+    updates_query = Activity.query.filter(Activity.clique_id.in_(user_clique_ids))
+    before = request.args.get('before', type=int)
+    if before is not None:
+        updates_query = updates_query.filter(Activity.id < before)
+    updates = updates_query.order_by(Activity.id.desc()).limit(FEED_PAGE_SIZE + 1).all() if user_clique_ids else []
+    older_updates = updates[FEED_PAGE_SIZE - 1].id if len(updates) > FEED_PAGE_SIZE else None
+    updates = updates[:FEED_PAGE_SIZE]
+
+    # every member of the user's cliques, best score first within each clique, in one query
+    scores = func.coalesce(CliqueScore.score, 0)
+    members = db.session.query(CliqueUser.clique_id, User.id, User.name) \
+        .join(User, User.id == CliqueUser.user_id) \
+        .outerjoin(CliqueScore, and_(CliqueScore.clique_id == CliqueUser.clique_id,
+                                     CliqueScore.user_id == CliqueUser.user_id)) \
+        .filter(CliqueUser.clique_id.in_(user_clique_ids)) \
+        .order_by(CliqueUser.clique_id, scores.desc(), CliqueUser.user_id).all() if user_clique_ids else []
+
+    rankings = defaultdict(list)
+    for clique_id, user_id, user_name in members:
+        rankings[clique_id].append({"rank": len(rankings[clique_id]) + 1, "user_id": user_id, "name": user_name})
+
+    scoreboard_data = [{
+        "clique_name": clique["name"],
+        "ranking": rankings[clique["id"]]
+    } for clique in user_cliques]
 
     return render_template(
         "user/feed.html",
         name=current_user.name,
         logged_in=True,
         cliques=user_cliques,
-        updates=all_updates,
+        updates=updates,
+        older_updates=older_updates,
         scoreboards=scoreboard_data
     )
 
@@ -871,7 +1534,7 @@ def create_clique():
             description=description,
             visibility=visibility,
             icon=icon,
-            date_created=datetime.today().strftime('%Y-%m-%d'),
+            date_created=date.today(),
             admin_id=current_user.id
         )
         db.session.add(new_clique)
@@ -881,9 +1544,10 @@ def create_clique():
         membership = CliqueUser(
             user_id=current_user.id,
             clique_id=new_clique.id,
-            joined_date=datetime.today().strftime('%Y-%m-%d')
+            joined_date=date.today()
         )
         db.session.add(membership)
+        notify_clique_changed(new_clique.id)
         db.session.commit()
 
         return redirect(url_for('maptest'))
@@ -968,9 +1632,10 @@ def join_clique(clique_id):
     new_link = CliqueUser(
         user_id=current_user.id,
         clique_id=clique_id,
-        joined_date=datetime.today().strftime('%Y-%m-%d')
+        joined_date=date.today()
     )
     db.session.add(new_link)
+    record_activity("join", [clique_id], current_user)
     db.session.commit()
 
     return jsonify({"success": True, "message": "Successfully joined the clique!"})
@@ -996,24 +1661,21 @@ def search_cliques():
     if not query:
         return redirect(url_for('feed'))
 
-    visible_cliques = Clique.query.filter(Clique.visibility.in_(["Public", "Protected"])).all()
-    matched = []
-
-    for clique in visible_cliques:
-        name_score = fuzz.partial_ratio(query, clique.name.lower())
-        desc_score = fuzz.partial_ratio(query, clique.description.lower())
-
-        if name_score >= 60 or desc_score >= 60:
-            sort_score = name_score + (10 if name_score >= desc_score else 0)
-            matched.append((sort_score, clique))
-
-    matched.sort(key=lambda x: x[0], reverse=True)
-    sorted_cliques = [item[1] for item in matched]
-
-    admin_map = {clique.id: db.session.get(User, clique.admin_id) for clique in sorted_cliques}
-
-    member_counts = {clique.id: len(clique.users) for clique in sorted_cliques}
-    marker_counts = {clique.id: len(clique.markers) for clique in sorted_cliques}
+    ranked_ids = get_search_backend().search(query)
+    cliques_by_id = {clique.id: clique for clique in Clique.query.filter(Clique.id.in_(ranked_ids)).all()}
+    sorted_cliques = [cliques_by_id[clique_id] for clique_id in ranked_ids if clique_id in cliques_by_id]
+
+    admin_ids = {clique.admin_id for clique in sorted_cliques}
+    admins = {user.id: user for user in User.query.filter(User.id.in_(admin_ids)).all()}
+    admin_map = {clique.id: admins.get(clique.admin_id) for clique in sorted_cliques}
+
+    member_counts = dict(db.session.query(CliqueUser.clique_id, func.count())
+                         .filter(CliqueUser.clique_id.in_(ranked_ids)).group_by(CliqueUser.clique_id).all())
+    marker_counts = dict(db.session.query(UserMarker.clique_id, func.count())
+                         .filter(UserMarker.clique_id.in_(ranked_ids)).group_by(UserMarker.clique_id).all())
+    for clique in sorted_cliques:
+        member_counts.setdefault(clique.id, 0)
+        marker_counts.setdefault(clique.id, 0)
     user_clique_ids = {cu.clique_id for cu in current_user.cliques}
 
     return render_template(
@@ -1029,6 +1691,9 @@ def search_cliques():
     )
 
 
+AUTOCOMPLETE_SIZE = 10
+
+
 @app.route('/autocomplete')
 @login_required
 def autocomplete():
@@ -1036,15 +1701,7 @@ def autocomplete():
     if not term:
         return jsonify([])
 
-    cliques_list = Clique.query.filter(Clique.visibility.in_(["Public", "Protected"])).all()
-    matches = []
-
-    for clique in cliques_list:
-        if term in clique.name.lower() or term in clique.description.lower():
-            matches.append(clique.name)
-
-    # return unique names (limit to 10)
-    return jsonify(list(set(matches))[:10])
+    return jsonify(get_search_backend().complete(term, AUTOCOMPLETE_SIZE))
 
 
 @app.route('/request_join_protected/<int:clique_id>', methods=['POST'])
@@ -1203,9 +1860,10 @@ def accept_request(note_id, clique_id):
     new_link = CliqueUser(
         user_id=user.id,
         clique_id=clique_id,
-        joined_date=datetime.today().strftime('%Y-%m-%d')
+        joined_date=date.today()
     )
     db.session.add(new_link)
+    record_activity("join", [clique_id], user)
     db.session.delete(note)  # delete the notification
 
     new_notif = Notification( # add notification to the user that his request has been approved
@@ -1279,7 +1937,7 @@ def admin_control_room(clique_id):
             })
 
     time_window = request.args.get("range", "week")
-    today = datetime.today()
+    today = date.today()
     if time_window == "month":
         start_date = today - timedelta(days=30)
     elif time_window == "year":
@@ -1287,50 +1945,47 @@ def admin_control_room(clique_id):
     else:
         start_date = today - timedelta(days=7)
 
-    start_date_str = start_date.strftime('%Y-%m-%d')
+    clique_marker_ids = db.session.query(UserMarker.marker_id).filter_by(clique_id=clique_id).distinct()
 
     joined_count = CliqueUser.query.filter_by(clique_id=clique_id).filter(
-        CliqueUser.joined_date >= start_date_str).count()
+        CliqueUser.joined_date >= start_date).count()
 
     marker_count = UserMarker.query.filter_by(clique_id=clique_id).filter(
-        UserMarker.creation_date >= start_date_str).count()
+        UserMarker.creation_date >= start_date).count()
 
     review_count = db.session.query(Review).filter(
-        Review.creation_date >= start_date_str,
-        Review.marker_id.in_(
-            db.session.query(UserMarker.marker_id)
-                .filter_by(clique_id=clique_id)
-                .distinct()
-        )
+        Review.creation_date >= start_date,
+        Review.marker_id.in_(clique_marker_ids)
     ).count()
 
     if time_window == "year":
-        today = datetime.today()
+        unit = "year"
         labels = [str(today.year - i) for i in range(2, -1, -1)]
-
-        def extract(date_str):
-            return date_str[:4]
+        chart_start = date(today.year - 2, 1, 1)
     elif time_window == "month":
-        today = datetime.today().replace(day=1)
-        labels = [(today - timedelta(days=30 * i)).strftime('%Y-%m') for i in range(11, -1, -1)]
-
-        def extract(date_str):
-            return date_str[:7]
+        unit = "month"
+        first_of_month = today.replace(day=1)
+        months = [first_of_month - timedelta(days=30 * i) for i in range(11, -1, -1)]
+        labels = [month.strftime('%Y-%m') for month in months]
+        chart_start = months[0].replace(day=1)
     else:
-        today = datetime.today().date()
+        unit = "day"
         labels = [(today - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(6, -1, -1)]
+        chart_start = today - timedelta(days=6)
+
+    # counted per period by the database, over the charted range only (served by the date indexes)
+    def counts_by(column, *criteria):
+        bucket = date_bucket(column, unit)
+        return dict(
+            db.session.query(bucket, func.count())
+            .filter(column >= chart_start, *criteria)
+            .group_by(bucket)
+            .all()
+        )
 
-        def extract(date_str):
-            return date_str
-
-    members = CliqueUser.query.filter_by(clique_id=clique_id).all()
-    markers = UserMarker.query.filter_by(clique_id=clique_id).all()
-    marker_ids = [m.marker_id for m in markers]
-    reviews = Review.query.filter(Review.marker_id.in_(marker_ids)).all()
-
-    members_by = Counter(extract(m.joined_date) for m in members)
-    markers_by = Counter(extract(m.creation_date) for m in markers)
-    reviews_by = Counter(extract(r.creation_date) for r in reviews)
+    members_by = counts_by(CliqueUser.joined_date, CliqueUser.clique_id == clique_id)
+    markers_by = counts_by(UserMarker.creation_date, UserMarker.clique_id == clique_id)
+    reviews_by = counts_by(Review.creation_date, Review.marker_id.in_(clique_marker_ids))
 
     members_series = [members_by.get(label, 0) for label in labels]
     markers_series = [markers_by.get(label, 0) for label in labels]
@@ -1386,7 +2041,7 @@ def ban_user(clique_id, user_id):
         user_id=user_id,
         clique_id=clique_id,
         reason=reason,
-        ban_date=datetime.today().strftime('%Y-%m-%d')
+        ban_date=date.today()
     ))
     db.session.add(Notification(type="ban", user_id=user_id, clique_id=clique_id))
     delete_user_from_clique(clique_id, user_id)
@@ -1435,30 +2090,35 @@ def transfer_admin(clique_id, user_id):
 @login_required
 def user_reviews_map(user_id, clique_id):
     user = User.query.get_or_404(user_id)
+    return render_template(
+        "user/user_reviews_map.html",
+        user=user,
+        features_url=url_for('user_reviews_geojson', user_id=user_id, clique_id=clique_id),
+        logged_in=True,
+        name=current_user.name
+    )
 
-    # get markers that the user has reviewed
-    reviewed_marker_ids = db.session.query(Review.marker_id).filter_by(user_id=user_id).all()
-    reviewed_marker_ids = [mid[0] for mid in reviewed_marker_ids]
-
-    # out of those, get marker that are also in the given clique
-    clique_marker_ids = db.session.query(UserMarker.marker_id).filter_by(clique_id=clique_id).all()
-    clique_marker_ids = [mid[0] for mid in clique_marker_ids]
-
-    # intersection of reviewed + clique-owned markers
-    final_marker_ids = set(reviewed_marker_ids) & set(clique_marker_ids)
-
-    # extract specifically the markers ids
-    markers = Marker.query.filter(Marker.id.in_(final_marker_ids)).all()
 
-    features = []
-    for marker in markers:
-        review = Review.query.filter_by(user_id=user.id, marker_id=marker.id).first()
-        if not review:
-            continue
+def created_marker_ids(user_id, marker_ids):
+    return {mid for (mid,) in db.session.query(UserMarker.marker_id).filter(
+        UserMarker.user_id == user_id, UserMarker.marker_id.in_(marker_ids))}
 
-        is_creator = UserMarker.query.filter_by(user_id=user.id, marker_id=marker.id).first() is not None
 
-        features.append({
+@app.route('/user-reviews-map/<int:user_id>/<int:clique_id>/geojson')
+@login_required
+def user_reviews_geojson(user_id, clique_id):
+    User.query.get_or_404(user_id)
+
+    # markers of the clique that the user has reviewed, with the review
+    clique_marker_ids = db.session.query(UserMarker.marker_id).filter_by(clique_id=clique_id)
+    rows_query = db.session.query(Marker, Review) \
+        .join(Review, Review.marker_id == Marker.id) \
+        .filter(Review.user_id == user_id, Marker.id.in_(clique_marker_ids)) \
+        .order_by(Marker.id)
+
+    def to_features(rows):
+        created = created_marker_ids(user_id, [marker.id for marker, _ in rows])
+        return [{
             "type": "Feature",
             "geometry": {
                 "type": "Point",
@@ -1468,52 +2128,51 @@ def user_reviews_map(user_id, clique_id):
                 "marker_title": marker.description or "Untitled Marker",
                 "stars": review.stars,
                 "commentary": review.commentary or "",
-                "is_creator": is_creator
+                "is_creator": marker.id in created
             }
-        })
+        } for marker, review in rows]
+
+    return stream_feature_collection([], batched_rows(rows_query), to_features)
+
 
+@app.route('/user-events-map/<int:user_id>/<int:clique_id>')
+@login_required
+def user_events_map(user_id, clique_id):
+    user = User.query.get_or_404(user_id)
     return render_template(
-        "user/user_reviews_map.html",
+        "user/user_events_map.html",
         user=user,
-        features=features,
+        features_url=url_for('user_events_geojson', user_id=user_id, clique_id=clique_id),
         logged_in=True,
         name=current_user.name
     )
 
 
-@app.route('/user-events-map/<int:user_id>/<int:clique_id>')
+@app.route('/user-events-map/<int:user_id>/<int:clique_id>/geojson')
 @login_required
-def user_events_map(user_id, clique_id):
+def user_events_geojson(user_id, clique_id):
     user = User.query.get_or_404(user_id)
-    
-    evented_marker_ids = db.session.query(Event.marker_id).filter_by(user_id=user_id).all()
-    evented_marker_ids = [mid[0] for mid in evented_marker_ids]
-
-    clique_marker_ids = db.session.query(UserMarker.marker_id).filter_by(clique_id=clique_id).all()
-    clique_marker_ids = [mid[0] for mid in clique_marker_ids]
-
-    final_marker_ids = set(evented_marker_ids) & set(clique_marker_ids)
-
-    markers = Marker.query.filter(Marker.id.in_(final_marker_ids)).all()
 
-    features = []
-    for marker in markers:
-        events = Event.query.filter(Event.user_id == user.id, Event.marker_id == marker.id,
-                                    Event.clique_id == clique_id).all()
-
-        events_data = [
-            {
+    # markers of the clique that the user has added events to
+    evented_marker_ids = db.session.query(Event.marker_id).filter(Event.user_id == user_id, upcoming_events())
+    clique_marker_ids = db.session.query(UserMarker.marker_id).filter_by(clique_id=clique_id)
+    markers_query = Marker.query.filter(Marker.id.in_(evented_marker_ids), Marker.id.in_(clique_marker_ids)) \
+        .order_by(Marker.id)
+
+    def to_features(markers):
+        marker_ids = [marker.id for marker in markers]
+        events_by_marker = defaultdict(list)
+        for e in Event.query.filter(Event.user_id == user_id, Event.marker_id.in_(marker_ids),
+                                    Event.clique_id == clique_id, upcoming_events()).all():
+            events_by_marker[e.marker_id].append({
                 "date": e.date,
                 "time": e.time,
                 "description": e.description,
-                "user": db.session.get(User, e.user_id).name
-            }
-            for e in events
-        ]
-
-        is_creator = UserMarker.query.filter_by(user_id=user.id, marker_id=marker.id).first() is not None
+                "user": user.name
+            })
+        created = created_marker_ids(user_id, marker_ids)
 
-        features.append({
+        return [{
             "type": "Feature",
             "geometry": {
                 "type": "Point",
@@ -1521,18 +2180,12 @@ def user_events_map(user_id, clique_id):
             },
             "properties": {
                 "marker_title": marker.description or "Untitled Marker",
-                "events": events_data,
-                "is_creator": is_creator
+                "events": events_by_marker[marker.id],
+                "is_creator": marker.id in created
             }
-        })
+        } for marker in markers]
 
-    return render_template(
-        "user/user_events_map.html",
-        user=user,
-        features=features,
-        logged_in=True,
-        name=current_user.name
-    )
+    return stream_feature_collection([], batched_rows(markers_query), to_features)
 
 
 @app.route('/send_admin_invitation/<int:clique_id>/<int:user_id>', methods=['POST'])
@@ -1676,6 +2329,7 @@ def edit_user(user_id):
 
         user.email = new_email
         user.name = new_name
+        notify_member_changed(user)
         db.session.commit()
 
         return jsonify({"success": True, "message": "User updated successfully!"})
@@ -1726,7 +2380,7 @@ def edit_clique(clique_id):
     # sort reviews by marker name (alphabetically)
     sorted_reviews = sorted(reviews, key=lambda r: (r.marker.description or "").lower())
 
-    events = Event.query.filter_by(clique_id=clique_id)
+    events = Event.query.filter(Event.clique_id == clique_id, upcoming_events())
 
     for event in events:
         event.user = db.session.get(User, event.user_id)
@@ -1819,6 +2473,6 @@ def delete_clique_route(clique_id):
 
 if __name__ == "__main__":
     with app.app_context():
-        db.create_all()
+        upgrade_database()
     app.run(debug=True)
    
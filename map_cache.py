@@ -0,0 +1,174 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from itertools import chain
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from databases import Marker, Review, Event, UserMarker, CliqueUser, MapChange
+
+""" cache of serialized, compressed /geojson-features and /clique-geojson responses. Entries are stored under the
+response's ETag, which already changes with every write to the cliques involved, so a stale entry is never served;
+the session hooks below also drop the entries of the cliques a commit touched so the LRU bound is spent on live ones.
+
+MAP_CACHE_BACKEND=memory (default) keeps the entries in each worker, MAP_CACHE_BACKEND=sqlite shares them between
+the workers of a host through the file at MAP_CACHE_PATH. MAP_CACHE_SIZE bounds the number of entries """
+
+
+class MemoryCacheBackend:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # key -> (value, tags), in LRU order
+        self.keys_by_tag = {}
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            self.entries.move_to_end(key)
+            return entry[0]
+
+    def _delete(self, key):
+        _, tags = self.entries.pop(key)
+        for tag in tags:
+            keys = self.keys_by_tag[tag]
+            keys.discard(key)
+            if not keys:
+                del self.keys_by_tag[tag]
+
+    def set(self, key, value, tags):
+        with self.lock:
+            if key in self.entries:
+                self._delete(key)
+            self.entries[key] = (value, set(tags))
+            for tag in tags:
+                self.keys_by_tag.setdefault(tag, set()).add(key)
+            while len(self.entries) > self.max_entries:
+                self._delete(next(iter(self.entries)))
+
+    def delete_tagged(self, tags):
+        with self.lock:
+            for key in {key for tag in tags for key in self.keys_by_tag.get(tag, ())}:
+                self._delete(key)
+
+
+class SqliteCacheBackend:
+    """ entries in a local SQLite file, visible to every worker process on the host """
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = None
+        self.pid = None
+
+    def _connection(self):
+        # one connection per process, a connection inherited through fork must not be reused
+        if self.conn is None or self.pid != os.getpid():
+            self.conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value BLOB, used REAL)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS ix_entries_used ON entries (used)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS tags (tag TEXT, key TEXT, PRIMARY KEY (tag, key))")
+            self.pid = os.getpid()
+        return self.conn
+
+    def get(self, key):
+        with self.lock:
+            conn = self._connection()
+            row = conn.execute("SELECT value FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE entries SET used = ? WHERE key = ?", (time.time(), key))
+            return row[0]
+
+    def set(self, key, value, tags):
+        with self.lock:
+            conn = self._connection()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute("INSERT OR REPLACE INTO entries (key, value, used) VALUES (?, ?, ?)", (key, value, time.time()))
+                conn.executemany("INSERT OR IGNORE INTO tags (tag, key) VALUES (?, ?)", [(tag, key) for tag in tags])
+                excess = conn.execute("SELECT COUNT(*) FROM entries").fetchone()[0] - self.max_entries
+                if excess > 0:
+                    conn.execute("DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY used LIMIT ?)", (excess,))
+                    conn.execute("DELETE FROM tags WHERE key NOT IN (SELECT key FROM entries)")
+
+    def delete_tagged(self, tags):
+        if not tags:
+            return
+        with self.lock:
+            conn = self._connection()
+            placeholders = ",".join("?" * len(tags))
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                conn.execute(f"DELETE FROM entries WHERE key IN (SELECT key FROM tags WHERE tag IN ({placeholders}))", tags)
+                conn.execute(f"DELETE FROM tags WHERE tag IN ({placeholders})", tags)
+
+
+class MapCache:
+    def __init__(self, backend):
+        self.backend = backend
+
+    def get(self, key):
+        """ (body, headers) of a cached response, or None """
+        value = self.backend.get(key)
+        if value is None:
+            return None
+        headers, body = bytes(value).split(b'\n', 1)
+        return body, json.loads(headers)
+
+    def set(self, key, body, headers, clique_ids):
+        self.backend.set(key, json.dumps(headers).encode() + b'\n' + body, [str(clique_id) for clique_id in clique_ids])
+
+    def invalidate_cliques(self, clique_ids):
+        self.backend.delete_tagged([str(clique_id) for clique_id in clique_ids])
+
+
+def create_backend():
+    max_entries = int(os.getenv("MAP_CACHE_SIZE", "2000"))
+    if os.getenv("MAP_CACHE_BACKEND", "memory") == "sqlite":
+        return SqliteCacheBackend(os.getenv("MAP_CACHE_PATH", "map_cache.sqlite"), max_entries)
+    return MemoryCacheBackend(max_entries)
+
+
+map_cache = MapCache(create_backend())
+
+
+# cliques touched by the session's flushes, invalidated once the transaction commits
+@event.listens_for(Session, 'after_flush')
+def _collect_changed_cliques(session, flush_context):
+    changed = session.info.setdefault('map_cache_cliques', set())
+    marker_ids = set()
+    for obj in chain(session.new, session.dirty, session.deleted):
+        # read from the instance dict: a deleted row can't be loaded anymore
+        state = obj.__dict__
+        if isinstance(obj, (UserMarker, CliqueUser, Event, MapChange)):  # map changes cover bulk deletes too
+            changed.add(state.get('clique_id'))
+        elif isinstance(obj, Marker):
+            marker_ids.add(state.get('id'))
+        elif isinstance(obj, Review):
+            marker_ids.add(state.get('marker_id'))
+
+    marker_ids.discard(None)
+    if marker_ids:
+        changed.update(session.connection().execute(
+            select(UserMarker.clique_id).where(UserMarker.marker_id.in_(marker_ids)).distinct()
+        ).scalars())
+    changed.discard(None)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_changed_cliques(session):
+    changed = session.info.pop('map_cache_cliques', None)
+    if changed:
+        map_cache.invalidate_cliques(changed)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_cliques(session):
+    session.info.pop('map_cache_cliques', None)
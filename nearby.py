@@ -0,0 +1,166 @@
+import heapq
+import math
+import threading
+from databases import db, Marker, UserMarker, MapChange, map_change_ids, map_change_log_start
+
+""" nearest-marker search: a KD-tree over every marker, kept in memory per process and caught up with other
+processes' writes through the map change log """
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def to_xyz(lat, lng):
+    # unit sphere coordinates, where straight-line (chord) distance grows with the great-circle distance
+    phi, lam = math.radians(lat), math.radians(lng)
+    return math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam), math.sin(phi)
+
+
+def chord_for_meters(meters):
+    return 2 * math.sin(min(meters / EARTH_RADIUS_M, math.pi) / 2)
+
+
+def haversine_m(lat1, lng1, lat2, lng2):
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    a = math.sin((phi2 - phi1) / 2) ** 2 + \
+        math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+class NearbyIndex:
+    """ 3-d KD-tree of marker positions. Markers added after the last build hang off the tree's leaves, removed
+    ones stay in the tree but are skipped; once those outnumber the markers it was built with, it is rebuilt """
+
+    def __init__(self, change_id=0):
+        self.change_id = change_id  # last map change reflected here
+        self.points = {}  # marker_id -> (xyz, lat, lng, clique ids)
+        self.root = None  # node: [marker_id, xyz, axis, left, right]
+        self.built_size = 0
+        self.stale_nodes = 0  # inserted or removed since the last build
+
+    def build(self):
+        def build_node(items, depth):
+            if not items:
+                return None
+            axis = depth % 3
+            items.sort(key=lambda item: item[1][axis])
+            mid = len(items) // 2
+            marker_id, xyz = items[mid]
+            return [marker_id, xyz, axis, build_node(items[:mid], depth + 1), build_node(items[mid + 1:], depth + 1)]
+
+        self.root = build_node([(marker_id, point[0]) for marker_id, point in self.points.items()], 0)
+        self.built_size = len(self.points)
+        self.stale_nodes = 0
+
+    def _maybe_rebuild(self):
+        self.stale_nodes += 1
+        if self.stale_nodes > max(64, self.built_size):
+            self.build()
+
+    def add(self, marker_id, lat, lng, clique_ids):
+        known = self.points.get(marker_id)
+        xyz = to_xyz(lat, lng)
+        self.points[marker_id] = (xyz, lat, lng, set(clique_ids))
+        if known is not None and known[0] == xyz:
+            return  # only the cliques changed, the node is still right
+
+        new_node = [marker_id, xyz, 0, None, None]
+        if self.root is None:
+            self.root = new_node
+        else:
+            node = self.root
+            while True:
+                side = 3 if xyz[node[2]] < node[1][node[2]] else 4
+                if node[side] is None:
+                    new_node[2] = (node[2] + 1) % 3
+                    node[side] = new_node
+                    break
+                node = node[side]
+        self._maybe_rebuild()
+
+    def remove(self, marker_id):
+        if self.points.pop(marker_id, None) is not None:
+            self._maybe_rebuild()
+
+    def nearest(self, lat, lng, k, clique_ids, max_meters=None):
+        """ [(distance in meters, marker_id)] of the k markers closest to (lat, lng) that belong to one of the
+        cliques, nearest first """
+        target = to_xyz(lat, lng)
+        bound = chord_for_meters(max_meters) ** 2 if max_meters is not None else float('inf')
+        best = []  # max-heap of (-squared chord, marker_id)
+        found = set()
+
+        def worst():
+            return -best[0][0] if len(best) == k else bound
+
+        def visit(node):
+            if node is None:
+                return
+            marker_id, xyz, axis = node[0], node[1], node[2]
+            point = self.points.get(marker_id)
+            # skip removed markers and nodes left behind by a marker that was re-added elsewhere
+            if point is not None and point[0] == xyz and point[3] & clique_ids and marker_id not in found:
+                d2 = (xyz[0] - target[0]) ** 2 + (xyz[1] - target[1]) ** 2 + (xyz[2] - target[2]) ** 2
+                if d2 <= worst():
+                    found.add(marker_id)
+                    heapq.heappush(best, (-d2, marker_id))
+                    if len(best) > k:
+                        found.discard(heapq.heappop(best)[1])
+
+            diff = target[axis] - xyz[axis]
+            near, far = (node[3], node[4]) if diff < 0 else (node[4], node[3])
+            visit(near)
+            if diff * diff <= worst():
+                visit(far)
+
+        with _lock:  # other requests' catching up inserts into the tree and rebuilds it
+            if k > 0:
+                visit(self.root)
+
+            results = []
+            for _, marker_id in best:
+                _, point_lat, point_lng, _ = self.points[marker_id]
+                results.append((haversine_m(lat, lng, point_lat, point_lng), marker_id))
+        return sorted(results)
+
+
+_index = None
+_lock = threading.RLock()
+
+
+def _load_markers(index, marker_ids=None):
+    # positions and clique links of the given markers (all of them when None), markers that no longer exist or
+    # have no clique left are dropped
+    query = db.session.query(Marker.id, Marker.lat, Marker.long, UserMarker.clique_id) \
+        .join(UserMarker, UserMarker.marker_id == Marker.id)
+    if marker_ids is not None:
+        query = query.filter(Marker.id.in_(marker_ids))
+
+    rows = {}
+    for marker_id, lat, lng, clique_id in query.all():
+        rows.setdefault(marker_id, (lat, lng, set()))[2].add(clique_id)
+
+    for marker_id in (marker_ids or []):
+        if marker_id not in rows:
+            index.remove(marker_id)
+    for marker_id, (lat, lng, clique_ids) in rows.items():
+        index.add(marker_id, lat, lng, clique_ids)
+
+
+def get_nearby_index():
+    """ the process' index, built on first use and then brought up to date with the markers added or removed since
+    (by any process) by replaying the map change log, or built again when the entries to replay were pruned """
+    global _index
+    with _lock:
+        settled, latest = map_change_ids()
+        if _index is None or (latest > _index.change_id and _index.change_id < map_change_log_start()):
+            _index = NearbyIndex(settled)
+            _load_markers(_index)
+            _index.build()
+        elif latest > _index.change_id:
+            changed = [marker_id for (marker_id,) in db.session.query(MapChange.marker_id).filter(
+                MapChange.id > _index.change_id, MapChange.id <= latest, MapChange.marker_id.isnot(None)
+            ).distinct()]
+            if changed:
+                _load_markers(_index, changed)
+            _index.change_id = settled  # what lies above is replayed again next time
+        return _index
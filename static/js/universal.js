@@ -33,8 +33,6 @@ if (document.getElementById("map") && !window.disableUniversalMap) {
   }).addTo(map);
 
 
-  let allGeoJsonLayer = null;
-
   function getStarDisplay(avg) {
     let fullStars = Math.round(avg);
     let starsHtml = '';
@@ -117,200 +115,388 @@ if (document.getElementById("map") && !window.disableUniversalMap) {
     return text.substring(0, maxLength).trim() + '...';
   }
 
+  // one GeoJSON layer per loaded marker tile, keyed like the grid layer's own tiles ("x:y:z")
+  const tileMarkers = {};
+
+  // decoder for the packed columnar tiles sent for Accept: application/x-geocliques-compact (see compact.py for the
+  // layout): the same slim features and clusters as the GeoJSON tiles, one block per clique, read from typed arrays
+  // without parsing any JSON per marker
+  function decodeCompactMarkers(buffer) {
+    const view = new DataView(buffer);
+    const NO_DATE = 0xFFFF;
+    const features = [];
+
+    let offset = 0;
+    while (offset < buffer.byteLength) {
+      const magic = String.fromCharCode(...new Uint8Array(buffer, offset, 4));
+      if (magic !== 'GCM1') {
+        throw new Error(`Unknown marker format: ${magic}`);
+      }
+
+      const count = view.getUint32(offset + 4, true);
+      const headerLength = view.getUint32(offset + 8, true);
+      const header = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, offset + 12, headerLength)));
+
+      // typed arrays read the columns in place, the server aligns them (and the next block) to 4 bytes
+      offset += 12 + headerLength;
+      function column(ArrayType) {
+        const array = new ArrayType(buffer, offset, count);
+        offset += count * ArrayType.BYTES_PER_ELEMENT;
+        return array;
+      }
+      const lat = column(Float32Array);
+      const long = column(Float32Array);
+      const markerId = column(Uint32Array);
+      const averageReview = column(Float32Array);
+      const totalReviews = column(Uint32Array);
+      const pointCount = column(Uint32Array);
+      const cliqueIndex = column(Uint16Array);
+      const dateIndex = column(Uint16Array);
+      const expansionZoom = column(Uint8Array);
+      offset += -count & 3;
+
+      for (let i = 0; i < count; i++) {
+        const [cliqueId, cliqueName, cliqueColor, icon] = header.cliques[cliqueIndex[i]];
+        const properties = {
+          clique_id: cliqueId,
+          clique_name: cliqueName,
+          clique_color: cliqueColor,
+          icon: icon,
+          // ratings are stored with 2 decimals, float32 only blurs the digits after them
+          average_review: Math.round(averageReview[i] * 100) / 100
+        };
+
+        if (pointCount[i] > 1) {
+          properties.cluster = true;
+          properties.point_count = pointCount[i];
+          properties.expansion_zoom = expansionZoom[i];
+        } else {
+          properties.marker_id = markerId[i];
+          properties.total_reviews = totalReviews[i];
+          properties.next_event_date = dateIndex[i] === NO_DATE ? null : header.dates[dateIndex[i]];
+        }
+
+        features.push({
+          type: 'Feature',
+          geometry: { type: 'Point', coordinates: [long[i], lat[i]] },
+          properties: properties
+        });
+      }
+    }
+    return features;
+  }
+
+  function buildMarkersLayer(data) {
+    const selectedCliqueIds = getSelectedCliqueIds();
+
+    return L.geoJSON(data, {
+      filter: feature => selectedCliqueIds.includes(feature.properties.clique_id),
+      pointToLayer: function (feature, latlng) {
+        // tiles are shared by every member of a clique, the per-user clique colors are applied here
+        feature.properties.clique_color = feature.properties.clique_color || window.cliqueColors[feature.properties.clique_id];
+
+        if (feature.properties.cluster) {
+          return clusterMarker(feature, latlng);
+        }
+        return featureMarker(feature, latlng);
+      }
+    });
+  }
+
+  // markers are fetched per 256px web-mercator tile: Leaflet requests the visible tiles in parallel,
+  // and each tile is revalidated by ETag instead of downloading every marker again
+  const MarkerTileLayer = L.GridLayer.extend({
+    createTile: function (coords, done) {
+      const tile = document.createElement('div');
+      const key = this._tileCoordsToKey(coords);
+
+      fetch(`/tiles/${coords.z}/${coords.x}/${coords.y}.geojson`, {
+        headers: { 'Accept': 'application/x-geocliques-compact' }
+      })
+        .then(response => response.arrayBuffer())
+        .then(buffer => {
+          // the tile may have been unloaded while its request was in flight
+          if (this._tiles[key]) {
+            tileMarkers[key] = buildMarkersLayer(decodeCompactMarkers(buffer)).addTo(map);
+          }
+          done(null, tile);
+        })
+        .catch(error => done(error, tile));
+
+      return tile;
+    }
+  });
+
+  const markerTileLayer = new MarkerTileLayer({ maxZoom: 19 });
+  markerTileLayer.on('tileunload', e => {
+    const key = markerTileLayer._tileCoordsToKey(e.coords);
+    if (tileMarkers[key]) {
+      map.removeLayer(tileMarkers[key]);
+      delete tileMarkers[key];
+    }
+  });
+
   function loadMarkers() {
-    fetch('/geojson-features')
+    if (map.hasLayer(markerTileLayer)) {
+      markerTileLayer.redraw();
+    } else {
+      markerTileLayer.addTo(map);
+    }
+  }
+
+  // parser from "YYYY-MM-DD" to Date object
+  function parseDate(dateStr) {
+    const [year, month, day] = dateStr.split("-").map(Number);
+    return new Date(year, month - 1, day); // month is 0-indexed
+  }
+
+  // check if the event is between today and 3 days from now (inclusive)
+  function isWithinThreeDays(dateStr) {
+    const today = new Date();
+    today.setHours(0, 0, 0, 0);
+    const endDate = new Date(today);
+    endDate.setDate(today.getDate() + 3);
+    const eventDate = parseDate(dateStr);
+    return eventDate >= today && eventDate <= endDate;
+  }
+
+  function reviewListItem(r) {
+    return `
+      <li style="display: flex; align-items: flex-start; padding-top: 8px; word-break: break-word;">
+      ${
+        r.user_pic !== 'default.jpg'
+          ? `<img src="/static/files/avatars_profile_pics/${r.user_pic}"
+                  alt="User"
+                  style="width: 32px; height: 32px; border-radius: 50%; object-fit: cover; margin-right: 10px;">`
+          : `<i class="bi bi-person-circle"
+                 style="font-size: 2rem; color: #888; margin-right: 10px;"></i>`
+      }
+        <div>
+          ${getStarDisplay(r.stars)}
+          ${r.commentary ? `"${r.commentary}"` : ''}
+          <em>(${r.user})</em>
+        </div>
+      </li>`;
+  }
+
+  // next page of a popup's reviews, appended to the list just above the button
+  function loadMoreReviews(markerId, button) {
+    fetch(`/marker/${markerId}/reviews?cursor=${encodeURIComponent(button.dataset.cursor)}`)
       .then(response => response.json())
-      .then(data => {
-        if (allGeoJsonLayer && map.hasLayer(allGeoJsonLayer)) {
-          map.removeLayer(allGeoJsonLayer);
+      .then(page => {
+        button.previousElementSibling.insertAdjacentHTML('beforeend', page.reviews.map(reviewListItem).join(''));
+        if (page.next_cursor) {
+          button.dataset.cursor = page.next_cursor;
+        } else {
+          button.remove();
         }
+      })
+      .catch(error => console.error('Error loading reviews:', error));
+  }
 
-        const selectedCliqueIds = getSelectedCliqueIds();
-
-        allGeoJsonLayer = L.geoJSON(data, {
-          filter: feature => selectedCliqueIds.includes(feature.properties.clique_id),
-          pointToLayer: function (feature, latlng) {
-            const desc = feature.properties.description;
-            const cliqueName = feature.properties.clique_name;
-            const markerId = feature.properties.marker_id;
-            const avg = feature.properties.average_review.toFixed(1);
-            const total = feature.properties.total_reviews;
-            const userReview = feature.properties.user_review;
-            const otherReviews = feature.properties.reviews;
-            const userEvents = feature.properties.user_events;
-            const otherEvents = feature.properties.events;
-            const stars = getStarDisplay(avg);
-            const color = feature.properties.clique_color;
-            const markerIcon = feature.properties.icon;
-            const cliqueId = feature.properties.clique_id;
-
-            let popupContent = `
-              <div style="font-family: 'Poppins', sans-serif;">
-                <strong>${desc} <span style="color: gray; font-weight: normal;">(${cliqueName})</span></strong><br>
-                <div style="margin: 5px 0;">⚖️ Average Rating: ${stars} (${avg} / 5 from ${total} reviews)</div>
-            `;
-
-            if (userReview) {
-              const userStars = getStarDisplay(userReview.stars);
-              const userComment = userReview.commentary ? `"${truncateText(userReview.commentary, 40)}"`  : '';
-              popupContent += `
-                <hr>
-                <div style="color: gray;">
-                  <strong>Your Review:</strong><br>
-                  Stars: ${userStars}<br>
-                  ${userComment}
-                </div>
-                <a href="/edit-review/${markerId}">
-                  <button class="btn btn-info-small" style="margin-top:5px;">Edit Review</button>
-                </a>
-              `;
-            } else {
-              popupContent += `
-                <label>Leave a review:</label><br>
-                <div class="rating-stars" data-marker="${markerId}" data-selected="0" style="padding-bottom: 5px">
-                  ${[1, 2, 3, 4, 5].map(i => `<span class="review-star" data-value="${i}">&#9733;</span>`).join('')}
-                </div>
-                <div id="review-comment-${markerId}" class="review-editable" contenteditable="true"
-                    oninput="limitReviewText(this, ${markerId})"
-                    placeholder="Your review (optional)"
-                    style="border: 1px solid #ccc; padding: 6px; min-height: 60px;"></div>
-                <div id="charCount-${markerId}" style="font-size: 0.85em; color: grey;">500 characters remaining</div>
-                <br>
-                <button onclick="submitReview(${markerId})" class="btn btn-primary" style="padding: 4px 10px; font-size: 14px;">
-                  Submit Review
-                </button>
-              `;
-            }
+  // popup of a single marker, props holds the full feature properties (reviews and events included)
+  function buildPopupContent(props) {
+    const desc = props.description;
+    const cliqueName = props.clique_name;
+    const markerId = props.marker_id;
+    const avg = props.average_review.toFixed(1);
+    const total = props.total_reviews;
+    const userReview = props.user_review;
+    const otherReviews = props.reviews;
+    const userEvents = props.user_events;
+    const otherEvents = props.events;
+    const stars = getStarDisplay(avg);
+    const cliqueId = props.clique_id;
+
+    let popupContent = `
+      <div style="font-family: 'Poppins', sans-serif;">
+        <strong>${desc} <span style="color: gray; font-weight: normal;">(${cliqueName})</span></strong><br>
+        <div style="margin: 5px 0;">⚖️ Average Rating: ${stars} (${avg} / 5 from ${total} reviews)</div>
+    `;
 
+    if (userReview) {
+      const userStars = getStarDisplay(userReview.stars);
+      const userComment = userReview.commentary ? `"${truncateText(userReview.commentary, 40)}"`  : '';
+      popupContent += `
+        <hr>
+        <div style="color: gray;">
+          <strong>Your Review:</strong><br>
+          Stars: ${userStars}<br>
+          ${userComment}
+        </div>
+        <a href="/edit-review/${markerId}">
+          <button class="btn btn-info-small" style="margin-top:5px;">Edit Review</button>
+        </a>
+      `;
+    } else {
+      popupContent += `
+        <label>Leave a review:</label><br>
+        <div class="rating-stars" data-marker="${markerId}" data-selected="0" style="padding-bottom: 5px">
+          ${[1, 2, 3, 4, 5].map(i => `<span class="review-star" data-value="${i}">&#9733;</span>`).join('')}
+        </div>
+        <div id="review-comment-${markerId}" class="review-editable" contenteditable="true"
+            oninput="limitReviewText(this, ${markerId})"
+            placeholder="Your review (optional)"
+            style="border: 1px solid #ccc; padding: 6px; min-height: 60px;"></div>
+        <div id="charCount-${markerId}" style="font-size: 0.85em; color: grey;">500 characters remaining</div>
+        <br>
+        <button onclick="submitReview(${markerId})" class="btn btn-primary" style="padding: 4px 10px; font-size: 14px;">
+          Submit Review
+        </button>
+      `;
+    }
 
-            if (otherReviews.length > 0) {
-              popupContent += `
-                <hr>
-                <div><strong>📝 Other Reviews:</strong></div><div style="max-height: 140px; overflow-y: auto;">
-                  <ul style="padding-left: 18px; margin-top:5px;">
-              `;
-              otherReviews.forEach(r => {
-                popupContent += `
-                  <li style="display: flex; align-items: flex-start; padding-top: 8px; word-break: break-word;">
-                  ${
-                    r.user_pic !== 'default.jpg'
-                      ? `<img src="/static/files/avatars_profile_pics/${r.user_pic}"
-                              alt="User"
-                              style="width: 32px; height: 32px; border-radius: 50%; object-fit: cover; margin-right: 10px;">`
-                      : `<i class="bi bi-person-circle"
-                             style="font-size: 2rem; color: #888; margin-right: 10px;"></i>`
-                  }
-                    <div>
-                      ${getStarDisplay(r.stars)}
-                      ${r.commentary ? `"${r.commentary}"` : ''}
-                      <em>(${r.user})</em>
-                    </div>
-                  </li>`;
-              });
-              popupContent += `
-                  </ul>
-                </div>
-              `;
-            }
 
-            // check if any event is between today and 3 days from now (inclusive)
-            const today = new Date();
-            today.setHours(0, 0, 0, 0);
-            const endDate = new Date(today);
-            endDate.setDate(today.getDate() + 3);
-            const allEvents = userEvents.concat(otherEvents);
-
-            // parser from "YYYY-MM-DD" to Date object
-            function parseDate(dateStr) {
-              const [year, month, day] = dateStr.split("-").map(Number);
-              return new Date(year, month - 1, day); // month is 0-indexed
-            }
+    if (otherReviews.length > 0) {
+      popupContent += `
+        <hr>
+        <div><strong>📝 Other Reviews:</strong></div><div style="max-height: 140px; overflow-y: auto;">
+          <ul style="padding-left: 18px; margin-top:5px;">
+      `;
+      otherReviews.forEach(r => {
+        popupContent += reviewListItem(r);
+      });
+      popupContent += `
+          </ul>
+      `;
+      // only the newest reviews come with the marker, the rest are fetched page by page
+      if (props.reviews_cursor) {
+        popupContent += `
+          <button class="btn btn-info-small" data-cursor="${props.reviews_cursor}"
+                  onclick="loadMoreReviews(${markerId}, this)">More reviews</button>
+        `;
+      }
+      popupContent += `
+        </div>
+      `;
+    }
 
-            const hasEventInRange = allEvents.some(ev => {
-              const eventDate = parseDate(ev.date);
-              return eventDate >= today && eventDate <= endDate;
-            });
-
-            const allEventsSorted = userEvents.concat(otherEvents)
-              .map(e => ({
-                ...e,
-                dateObj: new Date(e.date)
-              }))
-              .sort((a, b) => a.dateObj - b.dateObj);
-
-            if (allEventsSorted.length > 0) {
-              popupContent += `
-                <hr>
-                <div><strong>🗓️ Events:</strong></div><div style="color: blue; max-height: 100px; overflow-y: auto;">
-                  <ul style="margin-top: 5px; list-style: none; padding: 0;">
-              `;
-
-              allEventsSorted.forEach(e => {
-                  const isOwnEvent = e.is_own_event; // assuming you pass a flag for user's own events
-                  const eventOwnerText = isOwnEvent
-                    ? `<strong>Your</strong> event on`
-                    : (e.user ? `<strong>${e.user}</strong>'s event on` : "Event on");
-
-                  popupContent += `
-                    <li style="text-align: center; margin-top: 5px; word-break: break-word;">
-                      ${eventOwnerText} <strong>${e.date}</strong> at <strong>${e.time}</strong><br>
-                      ${e.description}
-                    </li>
-                  `;
-                });
-
-              popupContent += `
-                  </ul>
-                </div>
-              `;
-            }
+    const allEventsSorted = userEvents.concat(otherEvents)
+      .map(e => ({
+        ...e,
+        dateObj: new Date(e.date)
+      }))
+      .sort((a, b) => a.dateObj - b.dateObj);
+
+    if (allEventsSorted.length > 0) {
+      popupContent += `
+        <hr>
+        <div><strong>🗓️ Events:</strong></div><div style="color: blue; max-height: 100px; overflow-y: auto;">
+          <ul style="margin-top: 5px; list-style: none; padding: 0;">
+      `;
+
+      allEventsSorted.forEach(e => {
+          const isOwnEvent = e.is_own_event; // assuming you pass a flag for user's own events
+          const eventOwnerText = isOwnEvent
+            ? `<strong>Your</strong> event on`
+            : (e.user ? `<strong>${e.user}</strong>'s event on` : "Event on");
+
+          popupContent += `
+            <li style="text-align: center; margin-top: 5px; word-break: break-word;">
+              ${eventOwnerText} <strong>${e.date}</strong> at <strong>${e.time}</strong><br>
+              ${e.description}
+            </li>
+          `;
+        });
 
-            popupContent += `
-              <div style="display: flex; justify-content: center; margin-top: 8px;">
-                <a class="btn btn-info-small" style="margin-right: 8px;" href="/add-event/${markerId}/${cliqueId}">Add Event</a>
-                <a class="btn btn-info-small" href="/edit-events/${markerId}/${cliqueId}">Edit Events</a>
-              </div>
-            `;
-
-            popupContent += `</div>`;
-
-            const iconSize = 40; // default to 40px
-
-            if (userEvents == 0 && otherEvents == 0) { //no events at all - icon color is black
-              var customIcon = L.divIcon({
-                className: 'custom-div-icon',
-                html: `<div class='marker-pin' style='background:${color}; width:${iconSize}px; height:${iconSize}px;'>
-                        <i class='bi ${markerIcon}' style='font-size:${iconSize * 0.6}px;'></i>
-                      </div>`,
-                iconSize: [iconSize, iconSize],
-                iconAnchor: [iconSize / 2, iconSize]
-              });
-            } else if (hasEventInRange) { //for events happenning 3 days from now - blue icon and pulsing effect
-              var customIcon = L.divIcon({
-                className: 'custom-div-icon-event',
-                html: `<div class='marker-pin' style='background:${color}; width:${iconSize}px; height:${iconSize}px;'>
-                        <i class='bi ${markerIcon}' style='font-size:${iconSize * 0.6}px;'></i>
-                      </div>`,
-                iconSize: [iconSize, iconSize],
-                iconAnchor: [iconSize / 2, iconSize]
-              });
-            } else {
-              var customIcon = L.divIcon({ //other events in future - blue icon
-                className: 'custom-div-icon',
-                html: `<div class='marker-pin' style='color: #0a0ef8; background:${color}; width:${iconSize}px; height:${iconSize}px;'>
-                        <i class='bi ${markerIcon}' style='font-size:${iconSize * 0.6}px;'></i>
-                      </div>`,
-                iconSize: [iconSize, iconSize],
-                iconAnchor: [iconSize / 2, iconSize]
-              });
-            }
+      popupContent += `
+          </ul>
+        </div>
+      `;
+    }
 
-            const marker = L.marker(latlng, { icon: customIcon }).bindPopup(popupContent);
-            marker.on("popupopen", () => initReviewStars(markerId));
-            return marker;
-          }
-        }).addTo(map);
+    popupContent += `
+      <div style="display: flex; justify-content: center; margin-top: 8px;">
+        <a class="btn btn-info-small" style="margin-right: 8px;" href="/add-event/${markerId}/${cliqueId}">Add Event</a>
+        <a class="btn btn-info-small" href="/edit-events/${markerId}/${cliqueId}">Edit Events</a>
+      </div>
+    `;
+
+    popupContent += `</div>`;
+    return popupContent;
+  }
+
+  function buildMarkerIcon(color, markerIcon, hasEvents, hasEventInRange) {
+    const iconSize = 40; // default to 40px
+
+    if (!hasEvents) { //no events at all - icon color is black
+      return L.divIcon({
+        className: 'custom-div-icon',
+        html: `<div class='marker-pin' style='background:${color}; width:${iconSize}px; height:${iconSize}px;'>
+                <i class='bi ${markerIcon}' style='font-size:${iconSize * 0.6}px;'></i>
+              </div>`,
+        iconSize: [iconSize, iconSize],
+        iconAnchor: [iconSize / 2, iconSize]
       });
+    } else if (hasEventInRange) { //for events happenning 3 days from now - blue icon and pulsing effect
+      return L.divIcon({
+        className: 'custom-div-icon-event',
+        html: `<div class='marker-pin' style='background:${color}; width:${iconSize}px; height:${iconSize}px;'>
+                <i class='bi ${markerIcon}' style='font-size:${iconSize * 0.6}px;'></i>
+              </div>`,
+        iconSize: [iconSize, iconSize],
+        iconAnchor: [iconSize / 2, iconSize]
+      });
+    }
+    return L.divIcon({ //other events in future - blue icon
+      className: 'custom-div-icon',
+      html: `<div class='marker-pin' style='color: #0a0ef8; background:${color}; width:${iconSize}px; height:${iconSize}px;'>
+              <i class='bi ${markerIcon}' style='font-size:${iconSize * 0.6}px;'></i>
+            </div>`,
+      iconSize: [iconSize, iconSize],
+      iconAnchor: [iconSize / 2, iconSize]
+    });
+  }
+
+  // slim features only carry what the pin needs, the popup details are fetched when it opens
+  function featureMarker(feature, latlng) {
+    const props = feature.properties;
+    const markerId = props.marker_id;
+
+    if (props.reviews === undefined) {
+      const hasEventInRange = props.next_event_date ? isWithinThreeDays(props.next_event_date) : false;
+      const icon = buildMarkerIcon(props.clique_color, props.icon, !!props.next_event_date, hasEventInRange);
+      const marker = L.marker(latlng, { icon: icon }).bindPopup(`<div style="font-family: 'Poppins', sans-serif;">Loading...</div>`);
+
+      marker.on("popupopen", () => {
+        fetch(`/marker/${markerId}/details`)
+          .then(response => response.json())
+          .then(details => {
+            marker.setPopupContent(buildPopupContent({ ...props, ...details }));
+            initReviewStars(markerId);
+          })
+          .catch(error => console.error('Error loading marker details:', error));
+      });
+      return marker;
+    }
+
+    const allEvents = props.user_events.concat(props.events);
+    const hasEventInRange = allEvents.some(ev => isWithinThreeDays(ev.date));
+    const icon = buildMarkerIcon(props.clique_color, props.icon, allEvents.length > 0, hasEventInRange);
+    const marker = L.marker(latlng, { icon: icon }).bindPopup(buildPopupContent(props));
+    marker.on("popupopen", () => initReviewStars(markerId));
+    return marker;
+  }
+
+  // server-side cluster: a bubble with the number of markers, clicking it zooms in until it splits
+  function clusterMarker(feature, latlng) {
+    const props = feature.properties;
+    const size = props.point_count < 10 ? 36 : props.point_count < 100 ? 44 : 52;
+    const icon = L.divIcon({
+      className: 'cluster-div-icon',
+      html: `<div class='cluster-pin' style='background:${props.clique_color}; width:${size}px; height:${size}px;'>
+              <span style='font-size:${size * 0.35}px;'>${props.point_count}</span>
+            </div>`,
+      iconSize: [size, size],
+      iconAnchor: [size / 2, size / 2]
+    });
+
+    const marker = L.marker(latlng, {
+      icon: icon,
+      title: `${props.point_count} places in ${props.clique_name} (${props.average_review.toFixed(1)} / 5)`
+    });
+    marker.on('click', () => map.setView(latlng, props.expansion_zoom));
+    return marker;
   }
 
   function getSelectedCliqueIds() {
@@ -368,22 +554,34 @@ if (document.getElementById("map") && !window.disableUniversalMap) {
       return;
     }
 
+    postMarker({
+      latitude: lat,
+      longitude: lng,
+      title: title,
+      rating: rating,
+      clique_id: cliqueId,
+      commentary: commentary
+    });
+  }
+
+  function postMarker(payload) {
     fetch('/add-marker', {
       method: 'POST',
       headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({
-        latitude: lat,
-        longitude: lng,
-        title: title,
-        rating: rating,
-        clique_id: cliqueId,
-        commentary: commentary
-      })
+      body: JSON.stringify(payload)
     })
       .then(response => response.json())
       .then(data => {
+        // the clique already has a similar marker here: review it instead, or confirm this is another place
+        if (data.duplicates) {
+          const existing = data.duplicates[0];
+          const merge = confirm(`"${existing.title}" is already on the map ${Math.round(existing.distance_m)} m away.\n\n` +
+            `OK: add your review to it\nCancel: add a new marker anyway`);
+          postMarker(merge ? { ...payload, merge_into: existing.marker_id } : { ...payload, allow_duplicate: true });
+          return;
+        }
         if (data.success) {
-          alert("Marker added successfully!");
+          alert(data.message);
           map.closePopup();
           map.eachLayer(layer => {
             if (layer instanceof L.Marker && layer.getPopup()) {
@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# main reads DATABASE_URL when it is imported, by the first test module that does
+_db_dir = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = "sqlite:///" + os.path.join(_db_dir, "tests.db")
@@ -0,0 +1,56 @@
+import pytest
+
+from main import app
+from databases import db, User, Clique
+from utils import upgrade_database
+from clique_search import SqliteSearchBackend, MemorySearchBackend, create_backend
+
+""" clique search tolerates typos and matches parts of words, with the database's text index as in memory """
+
+
+@pytest.fixture(scope="module")
+def cliques():
+    with app.app_context():
+        upgrade_database()
+        owner = User(name="owner", email="search-owner@example.com", password="x")
+        db.session.add(owner)
+        db.session.flush()
+        created = {}
+        for name, description, visibility in [("bgu places to eat", "food around campus", "Public"),
+                                              ("Burgers club", "the best patties in town", "Protected"),
+                                              ("Chess night", "weekly games", "Public"),
+                                              ("Secret burgers", "members only", "Private")]:
+            clique = Clique(name=name, description=description, visibility=visibility, icon="bi-geo-alt",
+                            admin_id=owner.id)
+            db.session.add(clique)
+            db.session.flush()
+            created[name] = clique.id
+        db.session.commit()
+        yield created
+        db.session.remove()
+
+
+@pytest.fixture(params=[SqliteSearchBackend, MemorySearchBackend])
+def backend(request, cliques):
+    with app.app_context():
+        yield request.param()
+
+
+def test_sqlite_uses_its_text_index(cliques):
+    with app.app_context():
+        assert isinstance(create_backend(), SqliteSearchBackend)
+
+
+def test_typo_query(backend, cliques):
+    assert backend.search("plces to eat")[:1] == [cliques["bgu places to eat"]]
+
+
+def test_substring_query(backend, cliques):
+    found = backend.search("rgers")
+    assert cliques["Burgers club"] in found
+    assert cliques["Secret burgers"] not in found  # private cliques aren't searchable
+    assert cliques["Chess night"] not in found
+
+
+def test_autocomplete_prefixes(backend, cliques):
+    assert backend.complete("ches ni", 10) == ["Chess night"]
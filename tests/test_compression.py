@@ -0,0 +1,63 @@
+import gzip
+import json
+
+import brotli
+import pytest
+
+from main import app, COMPRESS_MIN_SIZE
+from databases import db, User, Clique, CliqueUser, Marker, UserMarker
+from utils import upgrade_database, grid_cell
+
+""" the map data is compressed with the best encoding the client accepts, brotli first """
+
+MARKERS = 50
+
+
+@pytest.fixture(scope="module")
+def member():
+    with app.app_context():
+        upgrade_database()
+        user = User(name="member", email="compression@example.com", password="x")
+        db.session.add(user)
+        db.session.flush()
+        clique = Clique(name="compressed", description="compressed", visibility="Public", icon="bi-geo-alt",
+                        admin_id=user.id)
+        db.session.add(clique)
+        db.session.flush()
+        db.session.add(CliqueUser(user_id=user.id, clique_id=clique.id))
+        for i in range(MARKERS):
+            lat, lng = 32.0 + i * 0.001, 35.0 + i * 0.001
+            marker = Marker(lat=lat, long=lng, description=f"marker {i}", grid_cell=grid_cell(lat, lng))
+            db.session.add(marker)
+            db.session.flush()
+            db.session.add(UserMarker(user_id=user.id, marker_id=marker.id, clique_id=clique.id))
+        db.session.commit()
+        yield user.id
+        db.session.remove()
+
+
+def fetch(user_id, accept_encoding):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user_id)
+        session["_fresh"] = True
+    response = client.get("/geojson-features", headers={"Accept-Encoding": accept_encoding})
+    assert response.status_code == 200
+    assert "Accept-Encoding" in response.headers["Vary"]
+    return response
+
+
+@pytest.mark.parametrize("accept_encoding, encoding, decompress", [
+    ("gzip, deflate, br", "br", brotli.decompress),
+    ("gzip", "gzip", gzip.decompress),
+])
+def test_map_data_is_compressed(member, accept_encoding, encoding, decompress):
+    plain = fetch(member, "identity")
+    assert len(plain.data) > COMPRESS_MIN_SIZE
+    assert "Content-Encoding" not in plain.headers
+
+    response = fetch(member, accept_encoding)
+    assert response.headers["Content-Encoding"] == encoding
+    assert len(response.data) < len(plain.data)
+    assert json.loads(decompress(response.data)) == json.loads(plain.data)
+    assert response.headers["ETag"] != plain.headers["ETag"]  # caches mustn't mix up the encodings
@@ -0,0 +1,89 @@
+from datetime import date, timedelta
+
+import pytest
+from sqlalchemy import event
+
+from main import app
+from databases import db, User, Clique, CliqueUser, Marker, UserMarker, Review, Event
+from utils import upgrade_database, grid_cell
+
+""" the map endpoints load the user's markers with their reviews, events and authors in a fixed number of queries,
+however many markers there are """
+
+SMALL = 20
+LARGE = 10 * SMALL
+QUERY_BUDGET = 12  # 10 for the full map at the time of writing, counting the logged in user's own query
+
+
+def seed_clique(name, marker_count, members):
+    clique = Clique(name=name, description=name, visibility="Public", icon="bi-geo-alt", admin_id=members[0].id)
+    db.session.add(clique)
+    db.session.flush()
+    db.session.add_all([CliqueUser(user_id=user.id, clique_id=clique.id) for user in members])
+
+    for i in range(marker_count):
+        lat, lng = 31.0 + i * 0.001, 34.0 + i * 0.001
+        marker = Marker(lat=lat, long=lng, description=f"{name} {i}", total_reviews=len(members),
+                        stars_sum=4 * len(members), average_review=4.0, grid_cell=grid_cell(lat, lng))
+        db.session.add(marker)
+        db.session.flush()
+        db.session.add(UserMarker(user_id=members[0].id, marker_id=marker.id, clique_id=clique.id))
+        db.session.add_all([Review(stars=4, commentary="fine", marker_id=marker.id, user_id=user.id)
+                            for user in members])
+        db.session.add(Event(date=date.today() + timedelta(days=1), time="10:00", description="meetup",
+                             marker_id=marker.id, user_id=members[-1].id, clique_id=clique.id))
+    return clique
+
+
+@pytest.fixture(scope="module")
+def seeded():
+    with app.app_context():
+        upgrade_database()
+        master = User(name="master", email="adminadmin@gmail.com", password="x")
+        small_user = User(name="small", email="small@example.com", password="x")
+        large_user = User(name="large", email="large@example.com", password="x")
+        db.session.add_all([master, small_user, large_user])
+        db.session.flush()
+        small = seed_clique("small clique", SMALL, [small_user, master])
+        large = seed_clique("large clique", LARGE, [large_user, master])
+        db.session.commit()
+        yield {"master": master.id, "small_user": small_user.id, "large_user": large_user.id,
+               "small": small.id, "large": large.id}
+        db.session.remove()
+
+
+def count_queries(user_id, url):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session["_user_id"] = str(user_id)
+        session["_fresh"] = True
+
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    with app.app_context():
+        engine = db.engine
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            response = client.get(url)
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+    assert response.status_code == 200, response.data[:200]
+    return len(statements)
+
+
+@pytest.mark.parametrize("url", ["/geojson-features", "/geojson-features?slim=1"])
+def test_user_map_queries_do_not_grow_with_markers(seeded, url):
+    small = count_queries(seeded["small_user"], url)
+    large = count_queries(seeded["large_user"], url)
+    assert small <= QUERY_BUDGET
+    assert large == small
+
+
+def test_clique_map_queries_do_not_grow_with_markers(seeded):
+    small = count_queries(seeded["master"], f"/clique-geojson/{seeded['small']}")
+    large = count_queries(seeded["master"], f"/clique-geojson/{seeded['large']}")
+    assert small <= QUERY_BUDGET
+    assert large == small
@@ -0,0 +1,154 @@
+import hashlib
+import math
+import os
+import threading
+from collections import OrderedDict
+from datetime import date
+from databases import db, MapChange, map_change_ids
+
+""" web-mercator tile math and a content-addressed cache of per-clique marker tiles """
+
+MAX_TILE_ZOOM = 20
+
+
+def tile_for(lat, lng, zoom):
+    # standard slippy-map tile (x, y) containing the point at the given zoom
+    n = 1 << zoom
+    lat = max(min(lat, 85.0511), -85.0511)
+    x = int((lng + 180.0) / 360.0 * n)
+    y = int((1.0 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2.0 * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def is_valid_tile(zoom, x, y):
+    return 0 <= zoom <= MAX_TILE_ZOOM and 0 <= x < (1 << zoom) and 0 <= y < (1 << zoom)
+
+
+class TileCache:
+    """ tiles are stored once per distinct content (sha1 of the body), so the many identical tiles
+    (empty ones, mostly) share a blob. Blobs live in memory, or as files when a directory is given.
+    Tiles are keyed by (clique_id, z, x, y, format), format being "geojson" (the comma separated features of a JSON
+    array) or "compact" (a block of compact.py). Before serving, the cache replays the map change log written since
+    (by any process): a marker change drops the clique's tiles (of both formats) that contain the marker, a change
+    to the whole clique drops all of its tiles. The cache is emptied when the day changes, since tiles carry each
+    marker's next event date. """
+
+    def __init__(self, max_tiles=20000, directory=None):
+        self.max_tiles = max_tiles
+        self.directory = directory
+        self.tiles = OrderedDict()  # (clique_id, z, x, y, format) -> sha, in LRU order
+        self.blobs = {}  # sha -> body bytes (in-memory mode only)
+        self.refs = {}  # sha -> number of tiles pointing at it
+        self.keys_by_tile = {}  # (z, x, y) -> keys of the tiles cached there
+        self.day = date.today()
+        self.change_id = None  # last map change reflected here, None until the first catch up
+        self.replayed_id = 0  # latest map change replayed so far
+        self.lock = threading.RLock()
+        self.replay_lock = threading.Lock()
+
+    def _blob_path(self, sha):
+        return os.path.join(self.directory, sha[:2], f"{sha}.tile")
+
+    def _release(self, sha):
+        self.refs[sha] -= 1
+        if self.refs[sha] == 0:
+            del self.refs[sha]
+            if self.directory:
+                try:
+                    os.remove(self._blob_path(sha))
+                except OSError:
+                    pass
+            else:
+                del self.blobs[sha]
+
+    def _drop(self, key):
+        self._release(self.tiles.pop(key))
+        keys = self.keys_by_tile[key[1:4]]
+        keys.discard(key)
+        if not keys:
+            del self.keys_by_tile[key[1:4]]
+
+    def _check_day(self):
+        if date.today() != self.day:
+            for key in list(self.tiles):
+                self._drop(key)
+            self.day = date.today()
+
+    def get(self, key):
+        """ (sha, body) of a cached tile, or None """
+        with self.lock:
+            self._check_day()
+            sha = self.tiles.get(key)
+            if sha is None:
+                return None
+            self.tiles.move_to_end(key)
+            if not self.directory:
+                return sha, self.blobs[sha]
+
+        try:
+            with open(self._blob_path(sha), 'rb') as f:
+                return sha, f.read()
+        except OSError:
+            return None
+
+    def catch_up(self):
+        """ drop the tiles touched by the map changes logged since the last call, returns the latest change
+        reflected, to be handed to put for the tiles rendered from here on """
+        with self.replay_lock:
+            settled, latest = map_change_ids()
+            if self.change_id is None:
+                self.change_id = settled  # nothing is cached yet
+            elif latest > self.change_id:
+                for clique_id, lat, lng in db.session.query(MapChange.clique_id, MapChange.lat, MapChange.long).filter(
+                    MapChange.id > self.change_id, MapChange.id <= latest
+                ).distinct():
+                    if lat is None or lng is None:
+                        self.invalidate_clique(clique_id)
+                    else:
+                        self.invalidate_point(lat, lng, {clique_id})
+                self.change_id = settled  # what lies above is replayed again next time
+            with self.lock:
+                self.replayed_id = max(self.replayed_id, latest)
+            return latest
+
+    def put(self, key, body, as_of=None):
+        """ cache a tile rendered after catch_up returned as_of, unless a change replayed since may have made it
+        outdated already """
+        sha = hashlib.sha1(body).hexdigest()
+        with self.lock:
+            self._check_day()
+            if as_of is not None and self.replayed_id > as_of:
+                return sha
+
+            if sha not in self.refs:
+                if self.directory:
+                    os.makedirs(os.path.dirname(self._blob_path(sha)), exist_ok=True)
+                    with open(self._blob_path(sha), 'wb') as f:
+                        f.write(body)
+                else:
+                    self.blobs[sha] = body
+                self.refs[sha] = 0
+            self.refs[sha] += 1
+            self.tiles[key] = sha
+            self.keys_by_tile.setdefault(key[1:4], set()).add(key)
+
+            while len(self.tiles) > self.max_tiles:
+                self._drop(next(iter(self.tiles)))
+        return sha
+
+    def invalidate_point(self, lat, lng, clique_ids=None):
+        """ drop the one tile per zoom level that contains the point (for the given cliques, or all of them) """
+        with self.lock:
+            for zoom in range(MAX_TILE_ZOOM + 1):
+                x, y = tile_for(lat, lng, zoom)
+                cached = self.keys_by_tile.get((zoom, x, y), set())
+                for key in [k for k in cached if clique_ids is None or k[0] in clique_ids]:
+                    self._drop(key)
+
+    def invalidate_clique(self, clique_id):
+        with self.lock:
+            for key in [k for k in self.tiles if k[0] == clique_id]:
+                self._drop(key)
+
+
+tile_cache = TileCache(directory=os.getenv("TILE_CACHE_DIR") or None)
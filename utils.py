@@ -1,9 +1,20 @@
+import hashlib
+import math
 import random
 import re
+from collections import defaultdict
+from datetime import date, datetime, timedelta
 from matplotlib.colors import to_rgb
 import numpy as np
 from flask import current_app as app
-from databases import db, User, Review, Marker, Event, Clique, CliqueUser, UserMarker, BannedUser, Notification
+from rapidfuzz import fuzz
+from sqlalchemy import and_, or_, func, tuple_, case, select, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from nearby import haversine_m
+from clique_search import install_search_index
+from databases import db, upgrade_schema, User, Review, Marker, Event, Clique, CliqueUser, UserMarker, BannedUser, Notification, \
+    MapChange, Activity, CliqueScore, MAP_CHANGE_SETTLE, MAP_CHANGE_RETENTION
 
 PALETTE = [
     "#FE7743", "#273F4F", "#7C4585", "#E9A319",
@@ -47,6 +58,574 @@ def assign_clique_colors(clique_ids):
     return assigned
 
 
+# auxiliary functions related to the markers' spatial index
+GRID_BITS = 20  # cells per axis = 2^20, roughly 38m of longitude at the equator
+MAX_BBOX_CELLS = 16  # upper bound on grid cells used to cover a bounding box
+
+
+def _grid_coords(lat, long):
+    size = 1 << GRID_BITS
+    x = min(int((long + 180.0) / 360.0 * size), size - 1)
+    y = min(int((lat + 90.0) / 180.0 * size), size - 1)
+    return max(x, 0), max(y, 0)
+
+
+def _interleave(x, y, bits):
+    code = 0
+    for i in range(bits):
+        code |= ((x >> i) & 1) << (2 * i)
+        code |= ((y >> i) & 1) << (2 * i + 1)
+    return code
+
+
+def grid_cell(lat, long):
+    # z-order (morton) code of the finest grid cell containing the point, nearby points get nearby codes
+    x, y = _grid_coords(lat, long)
+    return _interleave(x, y, GRID_BITS)
+
+
+def parse_bbox(value):
+    # "minLon,minLat,maxLon,maxLat" -> tuple of floats clamped to valid coordinates, raises ValueError if malformed
+    parts = [float(p) for p in value.split(',')]
+    if len(parts) != 4:
+        raise ValueError("bbox must have exactly 4 values")
+    if not all(math.isfinite(p) for p in parts):
+        raise ValueError("bbox values must be finite numbers")
+
+    min_lon, min_lat, max_lon, max_lat = parts
+    if min_lon > max_lon or min_lat > max_lat:
+        raise ValueError("bbox minimums must not exceed maximums")
+
+    return (max(min_lon, -180.0), max(min_lat, -90.0), min(max_lon, 180.0), min(max_lat, 90.0))
+
+
+def bbox_cell_ranges(min_lon, min_lat, max_lon, max_lat):
+    # cover the box with the finest grid level using at most MAX_BBOX_CELLS cells
+    # each cell of that level is one contiguous [lo, hi) range of grid_cell codes
+    min_x, min_y = _grid_coords(min_lat, min_lon)
+    max_x, max_y = _grid_coords(max_lat, max_lon)
+
+    shift = 0
+    while ((max_x >> shift) - (min_x >> shift) + 1) * ((max_y >> shift) - (min_y >> shift) + 1) > MAX_BBOX_CELLS:
+        shift += 1
+
+    level_bits = GRID_BITS - shift
+    starts = sorted(
+        _interleave(cx, cy, level_bits)
+        for cx in range(min_x >> shift, (max_x >> shift) + 1)
+        for cy in range(min_y >> shift, (max_y >> shift) + 1)
+    )
+
+    # merge cells that are adjacent in z-order into a single range
+    ranges = []
+    for start in starts:
+        lo, hi = start << (2 * shift), (start + 1) << (2 * shift)
+        if ranges and ranges[-1][1] == lo:
+            ranges[-1][1] = hi
+        else:
+            ranges.append([lo, hi])
+    return ranges
+
+
+WORLD_BBOX = (-180.0, -90.0, 180.0, 90.0)
+
+
+def markers_in_bbox(min_lon, min_lat, max_lon, max_lat):
+    # SQL condition: indexed grid_cell ranges narrow the scan, the exact lat/long bounds trim the cell edges
+    cell_ranges = bbox_cell_ranges(min_lon, min_lat, max_lon, max_lat)
+    return and_(
+        or_(*[and_(Marker.grid_cell >= lo, Marker.grid_cell < hi) for lo, hi in cell_ranges]),
+        Marker.lat.between(min_lat, max_lat),
+        Marker.long.between(min_lon, max_lon)
+    )
+
+
+# auxiliary functions related to the cliques' map versions, bumped by every write to a clique's map data
+def marker_clique_ids(marker_id):
+    return [cid for (cid,) in db.session.query(UserMarker.clique_id).filter_by(marker_id=marker_id).distinct()]
+
+
+def get_clique_versions(clique_ids):
+    clique_ids = set(clique_ids)
+    if not clique_ids:
+        return {}
+    return dict(db.session.query(Clique.id, Clique.map_version).filter(Clique.id.in_(clique_ids)).all())
+
+
+def bump_clique_versions(clique_ids):
+    # single UPDATE ... SET map_version = map_version + 1 inside the caller's transaction, returns the new versions
+    clique_ids = set(clique_ids)
+    if not clique_ids:
+        return {}
+    Clique.query.filter(Clique.id.in_(clique_ids)).update(
+        {Clique.map_version: Clique.map_version + 1}, synchronize_session=False
+    )
+    return get_clique_versions(clique_ids)
+
+
+def map_etag(clique_versions, *scope):
+    # changes whenever one of the cliques is written to, scope holds whatever else the response depends on
+    return hashlib.sha1(repr((sorted(clique_versions.items()), scope)).encode()).hexdigest()
+
+
+# auxiliary functions related to the map change log behind /geojson-features?since=
+# a cursor is "<settled change id>.<digest of the user's cliques and the day>" (see map_change_ids), joining or
+# leaving a clique or the day changing (events are listed from today on) invalidates it, as does the log being pruned
+# past it
+def log_map_changes(clique_ids, marker=None):
+    # marker None: the change concerns every marker of the cliques
+    position = dict(marker_id=marker.id, lat=marker.lat, long=marker.long) if marker is not None else {}
+    db.session.add_all([MapChange(clique_id=clique_id, **position) for clique_id in set(clique_ids)])
+
+
+def map_scope_digest(clique_ids):
+    scope = ",".join(str(cid) for cid in sorted(clique_ids)) + "@" + date.today().isoformat()
+    return hashlib.sha1(scope.encode()).hexdigest()[:10]
+
+
+def make_map_cursor(change_id, clique_ids):
+    return f"{change_id}.{map_scope_digest(clique_ids)}"
+
+
+def prune_map_changes():
+    """ deletes the map change log entries older than MAP_CHANGE_RETENTION and returns how many there were, the
+    log's first id then tells readers whether they missed pruned entries. The newest settled entry is always kept:
+    map_change_ids looks for gaps above it """
+    now = datetime.now()
+    kept = db.session.query(func.max(MapChange.id)).filter(
+        or_(MapChange.created_at < now - MAP_CHANGE_SETTLE, MapChange.created_at.is_(None))
+    ).scalar()
+    last_pruned = db.session.query(func.max(MapChange.id)).filter(
+        or_(MapChange.created_at < now - MAP_CHANGE_RETENTION, MapChange.created_at.is_(None)),
+        MapChange.id < (kept or 0)
+    ).scalar()
+    if last_pruned is None:
+        return 0
+    deleted = MapChange.query.filter(MapChange.id <= last_pruned).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+def parse_map_cursor(value):
+    # returns (change id, clique digest), raises ValueError on a malformed cursor
+    change_id, digest = value.split(".")
+    change_id = int(change_id)
+    if change_id < 0:
+        raise ValueError("negative cursor")
+    return change_id, digest
+
+
+def map_changes_since(change_id, until_id, clique_ids):
+    """ (cliques changed as a whole, {(clique_id, marker_id)} changed markers) logged in (change_id, until_id] """
+    rows = db.session.query(MapChange.clique_id, MapChange.marker_id).filter(
+        MapChange.clique_id.in_(clique_ids), MapChange.id > change_id, MapChange.id <= until_id
+    ).distinct().all()
+    whole_cliques = {clique_id for clique_id, marker_id in rows if marker_id is None}
+    pairs = {(clique_id, marker_id) for clique_id, marker_id in rows if marker_id is not None}
+    return whole_cliques, pairs
+
+
+# auxiliary functions recording marker writes: they bump the map versions and log the change, which the in-memory
+# map indexes (clusters, tiles, nearby...) of every process replay once the writing transaction has committed
+def notify_marker_added(clique_id, marker):
+    bump_clique_versions([clique_id])
+    log_map_changes([clique_id], marker)
+
+
+def notify_marker_changed(marker):
+    # rating, reviews or events of the marker changed
+    if marker is None:
+        return
+    versions = bump_clique_versions(marker_clique_ids(marker.id))
+    log_map_changes(versions, marker)
+
+
+def notify_marker_removed(marker, clique_ids):
+    # clique_ids must be read before the marker's UserMarker links are deleted
+    versions = bump_clique_versions(clique_ids)
+    log_map_changes(versions, marker)  # synced as tombstones once the links are gone
+
+
+def notify_clique_changed(clique_id):
+    # bulk changes to a clique's events, or the clique itself was created or changed (picked up by the search index),
+    # its clusters and cached tiles can no longer be trusted
+    bump_clique_versions([clique_id])
+    log_map_changes([clique_id])
+
+
+def notify_member_changed(user):
+    # name or picture of a member, shown in the full map data of the user's cliques but not in clusters or tiles
+    # (and copied into their activity entries)
+    versions = bump_clique_versions(cu.clique_id for cu in user.cliques)
+    log_map_changes(versions)
+    update_activity_author(user)
+
+
+def notify_clique_removed(clique_id):
+    log_map_changes([clique_id])  # drops the clique from the in-memory indexes, its members' maps already lost it
+
+
+# auxiliary functions related to marker ratings, kept as running sums so that every review write is one atomic UPDATE
+def rating_average(stars_sum, total_reviews):
+    # SQL expression for average_review, 0 once the marker has no reviews left
+    return case((total_reviews > 0, func.round(stars_sum * 1.0 / total_reviews, 2)), else_=0.0)
+
+
+def update_marker_rating(marker, stars_sum, total_reviews):
+    # one UPDATE setting the aggregates from SQL expressions, the marker's attributes are refreshed from the row
+    Marker.query.filter_by(id=marker.id).update({
+        Marker.stars_sum: stars_sum,
+        Marker.total_reviews: total_reviews,
+        Marker.average_review: rating_average(stars_sum, total_reviews)
+    }, synchronize_session=False)
+    db.session.expire(marker, ['stars_sum', 'total_reviews', 'average_review'])
+
+
+def adjust_marker_rating(marker, stars_delta, reviews_delta=0):
+    """ adds a review's stars (and count) to the marker's aggregates. The database applies the deltas to the
+    current row, so concurrent reviews of the same marker can't overwrite each other """
+    update_marker_rating(marker, Marker.stars_sum + stars_delta, Marker.total_reviews + reviews_delta)
+
+
+def recount_marker_rating(marker):
+    # aggregates recomputed from the marker's reviews, after bulk moves of reviews between markers
+    update_marker_rating(
+        marker,
+        select(func.coalesce(func.sum(Review.stars), 0)).where(Review.marker_id == marker.id).scalar_subquery(),
+        select(func.count(Review.id)).where(Review.marker_id == marker.id).scalar_subquery()
+    )
+
+
+# auxiliary functions related to listing a marker's reviews newest first, a few inline in the map data and the rest
+# page by page from /marker/<id>/reviews. A cursor is "<creation date>.<id>" of the last review already listed
+REVIEWS_PREVIEW = 3
+
+
+def newest_reviews(marker_ids, per_marker, exclude_user_id=None):
+    """ the per_marker newest reviews of each marker (leaving out one user's), newest first, in a single query """
+    if not marker_ids:
+        return []
+    rank = func.row_number().over(
+        partition_by=Review.marker_id, order_by=(Review.creation_date.desc(), Review.id.desc())
+    ).label('rank')
+    ranked = db.session.query(Review.id, rank).filter(Review.marker_id.in_(marker_ids))
+    if exclude_user_id is not None:
+        ranked = ranked.filter(Review.user_id != exclude_user_id)
+    ranked = ranked.subquery()
+    return Review.query.join(ranked, ranked.c.id == Review.id).filter(ranked.c.rank <= per_marker) \
+        .order_by(Review.marker_id, Review.creation_date.desc(), Review.id.desc()).all()
+
+
+def make_review_cursor(review):
+    return f"{review.creation_date.isoformat()}.{review.id}"
+
+
+def reviews_before(cursor):
+    # SQL condition for the reviews listed after the cursor, raises ValueError on a malformed cursor
+    creation_date, review_id = cursor.split(".")
+    return tuple_(Review.creation_date, Review.id) < tuple_(date.fromisoformat(creation_date), int(review_id))
+
+
+# auxiliary functions related to near-duplicate markers: the same place added more than once to a clique
+DUPLICATE_RADIUS_M = 20
+DUPLICATE_TITLE_SCORE = 80  # rapidfuzz token_set_ratio, insensitive to word order and extra words
+DUPLICATE_BUCKET_DEG = 0.001  # at least DUPLICATE_RADIUS_M wide in longitude up to 80 degrees of latitude
+
+
+def is_similar_title(a, b):
+    return fuzz.token_set_ratio((a or "").lower().strip(), (b or "").lower().strip()) >= DUPLICATE_TITLE_SCORE
+
+
+def find_duplicate_markers(lat, long, title, clique_id):
+    """ [(distance in meters, marker)] of the clique's markers within DUPLICATE_RADIUS_M of the point and with a
+    similar title, closest first """
+    lat_margin = DUPLICATE_RADIUS_M / 111320
+    long_margin = lat_margin / max(math.cos(math.radians(lat)), 0.01)
+    candidates = Marker.query.join(UserMarker, UserMarker.marker_id == Marker.id).filter(
+        UserMarker.clique_id == clique_id,
+        markers_in_bbox(max(long - long_margin, -180.0), max(lat - lat_margin, -90.0),
+                        min(long + long_margin, 180.0), min(lat + lat_margin, 90.0))
+    ).distinct().all()
+
+    duplicates = []
+    for marker in candidates:
+        distance = haversine_m(lat, long, marker.lat, marker.long)
+        if distance <= DUPLICATE_RADIUS_M and is_similar_title(title, marker.description):
+            duplicates.append((distance, marker))
+    return sorted(duplicates, key=lambda d: d[0])
+
+
+def merge_marker_into(duplicate, keeper):
+    # the duplicate's reviews, events and clique links move to the keeper (a user who reviewed both keeps the
+    # keeper's review), then the keeper's rating is recomputed and the duplicate deleted
+    duplicate_cliques = marker_clique_ids(duplicate.id)
+    keeper_cliques = set(marker_clique_ids(keeper.id))
+
+    keeper_reviewers = db.session.query(Review.user_id).filter(Review.marker_id == keeper.id)
+    Review.query.filter(Review.marker_id == duplicate.id, Review.user_id.in_(keeper_reviewers)) \
+        .delete(synchronize_session=False)
+    Review.query.filter_by(marker_id=duplicate.id).update({Review.marker_id: keeper.id}, synchronize_session=False)
+    Event.query.filter_by(marker_id=duplicate.id).update({Event.marker_id: keeper.id}, synchronize_session=False)
+    UserMarker.query.filter(UserMarker.marker_id == duplicate.id, UserMarker.clique_id.in_(keeper_cliques)) \
+        .delete(synchronize_session=False)
+    UserMarker.query.filter_by(marker_id=duplicate.id).update({UserMarker.marker_id: keeper.id},
+                                                              synchronize_session=False)
+    Activity.query.filter_by(marker_id=duplicate.id).update({Activity.marker_id: keeper.id}, synchronize_session=False)
+    for marker in (keeper, duplicate):
+        db.session.expire(marker, ['reviews', 'events', 'users'])  # reloaded after the bulk updates
+
+    recount_marker_rating(keeper)
+    recount_clique_scores(set(duplicate_cliques) | keeper_cliques)
+    db.session.delete(duplicate)
+
+    notify_marker_removed(duplicate, duplicate_cliques)
+    for clique_id in set(duplicate_cliques) - keeper_cliques:
+        notify_marker_added(clique_id, keeper)
+    notify_marker_changed(keeper)
+
+
+def merge_duplicate_markers():
+    """ batch job: within every clique, merges each marker into the oldest earlier marker it duplicates.
+    Commits once per clique and returns the number of markers merged away """
+    merged = 0
+    clique_ids = [cid for (cid,) in db.session.query(UserMarker.clique_id).distinct().order_by(UserMarker.clique_id)]
+    for clique_id in clique_ids:
+        markers = Marker.query.join(UserMarker, UserMarker.marker_id == Marker.id) \
+            .filter(UserMarker.clique_id == clique_id).distinct().order_by(Marker.id).all()
+
+        kept = defaultdict(list)  # coarse lat/long bucket -> markers kept so far
+        for marker in markers:
+            lat_bucket = math.floor(marker.lat / DUPLICATE_BUCKET_DEG)
+            long_bucket = math.floor(marker.long / DUPLICATE_BUCKET_DEG)
+            keeper = next((
+                other
+                for dlat in (-1, 0, 1) for dlong in (-1, 0, 1)
+                for other in kept[(lat_bucket + dlat, long_bucket + dlong)]
+                if haversine_m(marker.lat, marker.long, other.lat, other.long) <= DUPLICATE_RADIUS_M
+                and is_similar_title(marker.description, other.description)
+            ), None)
+
+            if keeper is None:
+                kept[(lat_bucket, long_bucket)].append(marker)
+            else:
+                merge_marker_into(marker, keeper)
+                merged += 1
+        db.session.commit()
+    return merged
+
+
+# auxiliary functions related to the activity stream behind /feed
+def record_activity(kind, clique_ids, user, marker=None, review=None, **fields):
+    """ adds a feed entry to each of the cliques, in the caller's transaction. fields: commentary, event_date,
+    event_time, and date when it isn't today. A review's entries copy its stars and commentary and are deleted with
+    it """
+    if review is not None:
+        if review.id is None:
+            db.session.flush()
+        fields.update(review_id=review.id, stars=review.stars, commentary=review.commentary)
+    clique_names = dict(db.session.query(Clique.id, Clique.name).filter(Clique.id.in_(set(clique_ids))).all())
+    db.session.add_all([Activity(
+        type=kind,
+        clique_id=clique_id,
+        clique_name=clique_name,
+        user_id=user.id,
+        user_name=user.name,
+        user_pic=user.picture or "default.jpg",
+        marker_id=marker.id if marker else None,
+        marker_name=(marker.description or "Unnamed Marker") if marker else None,
+        **fields
+    ) for clique_id, clique_name in clique_names.items()])
+
+
+def update_activity_author(user, deleted=False):
+    # the author fields copied into the user's entries, after a profile change or the account's deletion
+    Activity.query.filter_by(user_id=user.id).update({
+        Activity.user_id: None if deleted else user.id,
+        Activity.user_name: "Deleted User" if deleted else user.name,
+        Activity.user_pic: "default.jpg" if deleted else (user.picture or "default.jpg")
+    }, synchronize_session=False)
+
+
+# auxiliary functions related to the cliques' scoreboards: a member earns MARKER_POINTS for every marker they add to
+# the clique and 1 to 5 points for every review of one of its markers, stored on the review when it is written
+MARKER_POINTS = 2
+
+
+def review_points(commentary):
+    # reviews of 16 to 25 words score best, very short or very long ones least
+    word_count = len(commentary.strip().split()) if commentary else 0
+    if word_count <= 3 or word_count > 40:
+        return 1
+    if word_count <= 7 or word_count > 35:
+        return 2
+    if word_count <= 10 or word_count > 30:
+        return 3
+    if word_count <= 15 or word_count > 25:
+        return 4
+    return 5
+
+
+def add_clique_scores(deltas):
+    """ deltas: {(clique_id, user_id): points}, added to the scoreboard rows (created as needed) with a single
+    INSERT ... ON CONFLICT DO UPDATE, so concurrent writes add up """
+    rows = [{"clique_id": clique_id, "user_id": user_id, "score": points}
+            for (clique_id, user_id), points in deltas.items() if points and user_id is not None and user_id > 0]
+    if not rows:
+        return
+    insert = postgresql_insert if db.engine.dialect.name == "postgresql" else sqlite_insert
+    statement = insert(CliqueScore).values(rows)
+    db.session.execute(statement.on_conflict_do_update(
+        index_elements=[CliqueScore.clique_id, CliqueScore.user_id],
+        set_={"score": CliqueScore.score + statement.excluded.score}
+    ))
+
+
+def add_review_score(marker_id, user_id, points):
+    # a review (or a change of its points) counts in every clique the marker belongs to
+    add_clique_scores({(clique_id, user_id): points for clique_id in marker_clique_ids(marker_id)})
+
+
+def remove_marker_scores(marker_id):
+    # takes back the points of a marker's clique links and reviews, before they are deleted
+    clique_ids = marker_clique_ids(marker_id)
+    deltas = defaultdict(int)
+    for clique_id, user_id in db.session.query(UserMarker.clique_id, UserMarker.user_id).filter_by(marker_id=marker_id):
+        deltas[(clique_id, user_id)] -= MARKER_POINTS
+    for user_id, points in db.session.query(Review.user_id, func.sum(Review.score)) \
+            .filter_by(marker_id=marker_id).group_by(Review.user_id):
+        for clique_id in clique_ids:
+            deltas[(clique_id, user_id)] -= points or 0
+    add_clique_scores(deltas)
+
+
+def recount_clique_scores(clique_ids):
+    # scoreboards rebuilt from the cliques' markers and reviews, after bulk changes and to fill a new table
+    clique_ids = set(clique_ids)
+    if not clique_ids:
+        return
+    CliqueScore.query.filter(CliqueScore.clique_id.in_(clique_ids)).delete(synchronize_session=False)
+
+    deltas = defaultdict(int)
+    for clique_id, user_id, count in db.session.query(UserMarker.clique_id, UserMarker.user_id, func.count()) \
+            .filter(UserMarker.clique_id.in_(clique_ids)).group_by(UserMarker.clique_id, UserMarker.user_id):
+        deltas[(clique_id, user_id)] += MARKER_POINTS * count
+
+    clique_markers = db.session.query(UserMarker.clique_id, UserMarker.marker_id) \
+        .filter(UserMarker.clique_id.in_(clique_ids)).distinct().subquery()
+    review_scores = db.session.query(clique_markers.c.clique_id, Review.user_id, func.sum(Review.score)) \
+        .join(Review, Review.marker_id == clique_markers.c.marker_id) \
+        .group_by(clique_markers.c.clique_id, Review.user_id)
+    for clique_id, user_id, points in review_scores:
+        deltas[(clique_id, user_id)] += points or 0
+
+    add_clique_scores(deltas)
+
+
+# auxiliary functions related to dates
+DATE_BUCKET_FORMATS = {"day": "%Y-%m-%d", "month": "%Y-%m", "year": "%Y"}
+
+
+def date_bucket(column, unit):
+    # SQL expression truncating a Date column to its 'YYYY-MM-DD', 'YYYY-MM' or 'YYYY' label, to group by in the database
+    if db.engine.dialect.name == "postgresql":
+        return func.to_char(column, {"day": "YYYY-MM-DD", "month": "YYYY-MM", "year": "YYYY"}[unit])
+    return func.strftime(DATE_BUCKET_FORMATS[unit], column)
+
+
+# auxiliary functions related to events, which stop being listed once their date has passed
+def upcoming_events():
+    # SQL condition for the events dated today or later, the past ones wait for the sweeper to delete them
+    return Event.date >= date.today()
+
+
+def make_event_cursor(event):
+    return f"{event.date.isoformat()}.{event.time}.{event.id}"
+
+
+def parse_event_cursor(value):
+    # returns (date, time, id) of the last event of the previous page, raises ValueError on a malformed cursor
+    event_date, rest = value.split(".", 1)
+    event_time, event_id = rest.rsplit(".", 1)
+    return date.fromisoformat(event_date), event_time, int(event_id)
+
+
+def events_after(cursor):
+    # SQL condition for the events that come after the cursor in (date, time, id) order
+    return tuple_(Event.date, Event.time, Event.id) > tuple_(*parse_event_cursor(cursor))
+
+
+def sweep_expired_events():
+    """ deletes the events dated before today with a single DELETE and returns how many there were.
+    Reads already leave them out, so no map data changes """
+    deleted = Event.query.filter(Event.date < date.today()).delete(synchronize_session=False)
+    db.session.commit()
+    return deleted
+
+
+# auxiliary functions related to upgrading an existing database
+def backfill_marker_grid_cells():
+    for marker in Marker.query.filter(Marker.grid_cell.is_(None)).all():
+        marker.grid_cell = grid_cell(marker.lat, marker.long)
+
+
+def backfill_marker_rating_sums():
+    # markers reviewed before stars_sum existed
+    for marker in Marker.query.filter(Marker.stars_sum == 0, Marker.total_reviews > 0).all():
+        recount_marker_rating(marker)
+
+
+def backfill_review_scores():
+    # reviews written before Review.score existed, scored in one bulk UPDATE by primary key
+    rows = [{"id": review_id, "score": review_points(commentary)}
+            for review_id, commentary in db.session.query(Review.id, Review.commentary).filter(Review.score.is_(None))]
+    if rows:
+        db.session.execute(update(Review), rows)
+
+
+def backfill_clique_scores():
+    if CliqueScore.query.first() is None:
+        recount_clique_scores(clique_id for (clique_id,) in db.session.query(Clique.id))
+
+
+def backfill_activity():
+    # a new activity table starts with the past week's markers and reviews, what the feed used to show
+    if Activity.query.first() is not None:
+        return
+    week_ago = date.today() - timedelta(days=7)
+    entries = []
+    for um in UserMarker.query.filter(UserMarker.creation_date >= week_ago).all():
+        entries.append((um.creation_date, "marker", um.user_id, [um.clique_id], um.marker, {}))
+    for r in Review.query.filter(Review.creation_date >= week_ago).all():
+        entries.append((r.creation_date, "review", r.user_id, marker_clique_ids(r.marker_id), r.marker, {"review": r}))
+
+    for day, kind, user_id, clique_ids, marker, fields in sorted(entries, key=lambda entry: entry[0]):
+        user = db.session.get(User, user_id)
+        if user is not None:
+            record_activity(kind, clique_ids, user, marker, date=day, **fields)
+
+
+def backfill_activity_review_ids():
+    # review entries written before Activity.review_id existed (a user reviews a marker once), the entries of reviews
+    # deleted since then are deleted too
+    review_id = select(Review.id).where(Review.marker_id == Activity.marker_id, Review.user_id == Activity.user_id) \
+        .limit(1).scalar_subquery()
+    legacy = Activity.query.filter(Activity.type == "review", Activity.review_id.is_(None))
+    legacy.update({Activity.review_id: review_id}, synchronize_session=False)
+    legacy.delete(synchronize_session=False)
+
+
+def upgrade_database():
+    upgrade_schema()
+    install_search_index()
+    backfill_marker_grid_cells()
+    backfill_marker_rating_sums()
+    backfill_review_scores()
+    backfill_clique_scores()
+    backfill_activity()
+    backfill_activity_review_ids()
+    db.session.commit()
+
+
 # auxiliary functions related to the registration process in the app
 def is_valid_password(password):
     return (
@@ -70,6 +649,7 @@ def delete_user(user_id):
 
     for review in list(user.reviews):
         delete_review_and_update_marker(review.id)
+    update_activity_author(user, deleted=True)
 
     created_links = UserMarker.query.filter_by(user_id=user.id).all()
     for link in created_links:
@@ -96,12 +676,14 @@ def delete_user(user_id):
     for link in non_admin_links:
         Event.query.filter_by(clique_id=link.clique_id, user_id=user.id).delete()
         db.session.delete(link)
+        notify_clique_changed(link.clique_id)
 
     Event.query.filter_by(user_id=user.id).delete()
 
     UserMarker.query.filter_by(user_id=user.id).delete()
     Notification.query.filter_by(user_id=user.id).delete()
     BannedUser.query.filter_by(user_id=user.id).delete()
+    CliqueScore.query.filter_by(user_id=user.id).delete()
 
     db.session.delete(user)
 
@@ -116,6 +698,7 @@ def delete_user_from_clique(clique_id, user_id):
         delete_review_and_update_marker(review.id)
 
     Event.query.filter_by(user_id=user_id, clique_id=clique_id).delete()
+    notify_clique_changed(clique_id)
 
 
 def perform_leave_clique(clique_id, user_id):
@@ -152,6 +735,8 @@ def delete_clique_and_contents(clique_id):
         delete_marker_and_contents(mid)
 
     Notification.query.filter_by(clique_id=clique_id).delete()
+    Activity.query.filter_by(clique_id=clique_id).delete()
+    CliqueScore.query.filter_by(clique_id=clique_id).delete()
     UserMarker.query.filter_by(clique_id=clique_id).delete()
     CliqueUser.query.filter_by(clique_id=clique_id).delete()
     BannedUser.query.filter_by(clique_id=clique_id).delete()
@@ -159,6 +744,7 @@ def delete_clique_and_contents(clique_id):
     clique = db.session.get(Clique, clique_id)
     if clique:
         db.session.delete(clique)
+    notify_clique_removed(clique_id)
 
 
 def delete_review_and_update_marker(review_id):
@@ -167,24 +753,32 @@ def delete_review_and_update_marker(review_id):
         return
 
     marker = review.marker
+    add_review_score(marker.id, review.user_id, -review.score)
+    Activity.query.filter_by(review_id=review.id).delete()
     db.session.delete(review)
+    adjust_marker_rating(marker, -review.stars, -1)
 
-    remaining_reviews = [r for r in marker.reviews if r.id != review.id]
-    marker.total_reviews = len(remaining_reviews)
-
-    if remaining_reviews:
-        marker.average_review = round(sum(r.stars for r in remaining_reviews) / len(remaining_reviews), 2)
+    if marker.total_reviews > 0:
+        notify_marker_changed(marker)
     else:
         # delete the marker and its associated data
+        remove_marker_scores(marker.id)
+        clique_ids = marker_clique_ids(marker.id)
         Event.query.filter_by(marker_id=marker.id).delete()
         UserMarker.query.filter_by(marker_id=marker.id).delete()
+        Activity.query.filter_by(marker_id=marker.id).delete()
         db.session.delete(marker)
+        notify_marker_removed(marker, clique_ids)
 
 
 def delete_marker_and_contents(marker_id):
+    remove_marker_scores(marker_id)
+    clique_ids = marker_clique_ids(marker_id)
     Review.query.filter_by(marker_id=marker_id).delete()  
     Event.query.filter_by(marker_id=marker_id).delete()  
     UserMarker.query.filter_by(marker_id=marker_id).delete() 
+    Activity.query.filter_by(marker_id=marker_id).delete()
     marker = db.session.get(Marker, marker_id)
     if marker:
         db.session.delete(marker)
+        notify_marker_removed(marker, clique_ids)